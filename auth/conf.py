@@ -14,6 +14,9 @@ dbUser = os.environ.get("AUTH_DB_USER", "auth")
 dbPdw = os.environ.get("AUTH_DB_PWD", "")
 dbHost = os.environ.get("AUTH_DB_HOST", "postgres")
 createDatabase = os.environ.get('AUTH_DB_CREATE', True)
+# materialized views are refreshed on background, at most once
+# every this many milliseconds
+dbViewRefreshDelay = int(os.environ.get("AUTH_DB_VIEW_REFRESH_DELAY", 500))
 
 
 # cache related configuration
@@ -23,13 +26,60 @@ cachePdw = os.environ.get("AUTH_CACHE_PWD", "")
 cacheHost = os.environ.get("AUTH_CACHE_HOST", "redis")
 cacheTtl = int(os.environ.get("AUTH_CACHE_TTL", 720))
 cacheDatabase = os.environ.get("AUTH_CACHE_DATABASE", "0")
+# decisions are also kept on each worker memory, in front of the cache
+# max number of entries and time to live in seconds. Size 0 disables it
+cacheLocalSize = int(os.environ.get("AUTH_CACHE_LOCAL_SIZE", 10000))
+cacheLocalTtl = int(os.environ.get("AUTH_CACHE_LOCAL_TTL", 5))
+# max number of pending invalidations handled by the background worker
+# 0 makes invalidations run on the request thread
+cacheInvalidationQueue = int(os.environ.get("AUTH_CACHE_INVALIDATION_QUEUE",
+                                            1000))
+
+# PDP related configuration
+# 'memory' keeps a compiled copy of all permissions and grants on
+# every worker. 'database' queries postgres on every cache miss
+pdpEngine = os.environ.get("AUTH_PDP_ENGINE", "memory")
+# max age in seconds of the in-memory policy before it is reloaded
+pdpEngineTtl = int(os.environ.get("AUTH_PDP_ENGINE_TTL", 60))
+# max number of (action, resource) pairs on a single /pdp/batch request
+pdpBatchLimit = int(os.environ.get("AUTH_PDP_BATCH_LIMIT", 200))
+# concurrent evaluations of the same decision are always coalesced on
+# each worker. If greater than 0, a lock with this duration in
+# milliseconds coalesces them across workers too
+pdpLockTimeout = int(os.environ.get("AUTH_PDP_LOCK_TIMEOUT", 0))
+
+# PAP related configuration
+# max number of operations on a single /pap/changeset request
+papChangesetLimit = int(os.environ.get("AUTH_PAP_CHANGESET_LIMIT", 1000))
 
 # kong related configuration
 kongURL = os.environ.get("AUTH_KONG_URL", "http://kong:8001")
+# timeouts in seconds to connect to kong and to wait for its answer
+kongConnectTimeout = float(os.environ.get("AUTH_KONG_CONNECT_TIMEOUT", 2))
+kongReadTimeout = float(os.environ.get("AUTH_KONG_READ_TIMEOUT", 5))
+# max number of retries of a failed call, with backoff
+kongRetries = int(os.environ.get("AUTH_KONG_RETRIES", 2))
+# max number of connections kept alive to kong
+kongPoolSize = int(os.environ.get("AUTH_KONG_POOL_SIZE", 10))
+# kong is configured on background. Pending operations are looked for
+# every this many seconds, and at most this many are executed at once
+kongOutboxInterval = float(os.environ.get("AUTH_KONG_OUTBOX_INTERVAL", 1))
+kongOutboxBatch = int(os.environ.get("AUTH_KONG_OUTBOX_BATCH", 20))
 
 
 # JWT token related configuration
 tokenExpiration = int(os.environ.get("AUTH_TOKEN_EXP", 420))
+# HS256 signs tokens with each user secret. RS256 and ES256 sign them
+# with the newest key on tokenKeysDir, and publish the public keys
+tokenAlgorithm = os.environ.get("AUTH_TOKEN_ALGORITHM", "HS256")
+tokenKeysDir = os.environ.get("AUTH_TOKEN_KEYS_DIR", "keys")
+tokenCheckSign = (os.environ.get("AUTH_TOKEN_CHECK_SIGN", "false") in
+                  ['true', 'True', 'TRUE'])
+# max number of decoded tokens kept on each worker memory
+tokenCacheSize = int(os.environ.get("AUTH_TOKEN_CACHE_SIZE", 10000))
+# claims of users that logged in recently, kept on each worker memory
+loginCacheSize = int(os.environ.get("AUTH_LOGIN_CACHE_SIZE", 1000))
+loginCacheTtl = int(os.environ.get("AUTH_LOGIN_CACHE_TTL", 300))
 
 # email related configuration
 emailHost = os.environ.get("AUTH_EMAIL_HOST", "NOEMAIL")
@@ -57,6 +107,17 @@ passwdHistoryLen = int(os.environ.get("AUTH_PASSWD_HISTORY_LEN", 4))
 
 passwdMinLen = int(os.environ.get("AUTH_PASSWD_MIN_LEN", 8))
 
+# pbkdf2-sha256 iterations of new password hashes. Hashes with less
+# iterations are replaced on the next login
+passwdHashIterations = int(os.environ.get("AUTH_PASSWD_HASH_ITERATIONS",
+                                          10000))
+# processes used by each worker to hash passwords. 0 hashes them on the
+# worker itself
+passwdHashWorkers = int(os.environ.get("AUTH_PASSWD_HASH_WORKERS", 2))
+# max number of pending hashes on each worker. Requests beyond it are
+# rejected with 503
+passwdHashQueue = int(os.environ.get("AUTH_PASSWD_HASH_QUEUE", 32))
+
 
 password_blackList = os.environ.get("AUTH_PASSWD_BLACKLIST",
                                     "password_blacklist.txt")
@@ -78,6 +139,33 @@ else:
     if not emailTLS:
         LOGGER.warning('Using e-mail without TLS is not safe')
 
+if pdpEngine not in ['memory', 'database']:
+    LOGGER.warning("Unknown PDP engine " + pdpEngine + ". Using 'memory'")
+    pdpEngine = 'memory'
+
+if pdpEngine == 'memory' and cacheName == 'NOCACHE':
+    # workers learn about policy changes made by the others through redis
+    LOGGER.warning("PDP engine 'memory' requires a cache. Using 'database'")
+    pdpEngine = 'database'
+
+if cacheName == 'NOCACHE' and (tokenCacheSize > 0 or loginCacheSize > 0):
+    # workers learn about revoked tokens and claims made by the others
+    # through redis
+    LOGGER.warning("Token and login caches require a cache. Disabling them")
+    tokenCacheSize = 0
+    loginCacheSize = 0
+
+if tokenAlgorithm not in ['HS256', 'RS256', 'ES256']:
+    LOGGER.warning("Unknown token algorithm " + tokenAlgorithm
+                   + ". Using 'HS256'")
+    tokenAlgorithm = 'HS256'
+elif tokenAlgorithm != 'HS256' and kongURL != 'DISABLED':
+    # Kong jwt credentials hold a user secret or a single public key,
+    # and can't follow the key rotation
+    LOGGER.warning(tokenAlgorithm + " tokens can't be verified by Kong."
+                   " Using 'HS256'. Set AUTH_KONG_URL to DISABLED to use it")
+    tokenAlgorithm = 'HS256'
+
 if passwdMinLen < 6:
     LOGGER.warning("Password minlen can't be less than 6.")
     passwdMinLen = 6
@@ -2,20 +2,57 @@
 # and generate a JWT token
 import time
 import binascii
+import hashlib
 import jwt
 import os
 
-from pbkdf2 import crypt
 from sqlalchemy.orm import exc as orm_exceptions
 from sqlalchemy import exc as sqlalchemy_exceptions
 
 import conf
 
-from database.flaskAlchemyInit import HTTPRequestError
-from database.Models import User
+from database.flaskAlchemyInit import HTTPRequestError, db
+from database.Models import User, UserGroup
 from database.flaskAlchemyInit import log
+import database.Cache as cache
+from utils.localCache import LocalCache
+import utils.metrics as metrics
+import utils.passwordHash as passwordHash
+import utils.signingKeys as signingKeys
 from auth.alarms import AlarmError
 
+# claims that only change with the user group memberships, by username.
+# They are kept until any of the user decisions is invalidated
+claims_cache = LocalCache(conf.loginCacheSize, conf.loginCacheTtl)
+
+
+# loads a user and its claims template with a single query
+def load_user(db_session, username):
+    template = claims_cache.get(username)
+    if template is not None:
+        metrics.inc('auth.login.hit')
+        user = db_session.query(User).filter_by(username=username).one()
+        if user.id == template['userid']:
+            return user, template
+    metrics.inc('auth.login.miss')
+
+    # a template loaded before an invalidation must not be stored
+    epoch = cache.local_epoch
+    user, groups = db_session.query(User, db.func.array_agg(UserGroup.group_id)) \
+        .outerjoin(UserGroup, UserGroup.user_id == User.id) \
+        .filter(User.username == username) \
+        .group_by(User.id).one()
+    template = {
+        'userid': user.id,
+        'username': user.username,
+        # users without groups get [None]
+        'groups': [g for g in groups if g is not None]
+    }
+    if epoch == cache.local_epoch:
+        claims_cache.set(username, template)
+    return user, template
+
+
 def authenticate(db_session, auth_data):
     if 'username' not in auth_data.keys():
         raise HTTPRequestError(400, 'missing username')
@@ -26,7 +63,7 @@ def authenticate(db_session, auth_data):
     passwd = auth_data['passwd']
 
     try:
-        user = db_session.query(User).filter_by(username=username.lower()).one()
+        user, template = load_user(db_session, username.lower())
     except orm_exceptions.NoResultFound:
         raise AlarmError(401, 'AuthenticationError', username)
     except sqlalchemy_exceptions.DBAPIError:
@@ -35,29 +72,111 @@ def authenticate(db_session, auth_data):
     if not user.hash:
         raise HTTPRequestError(401, 'This user is inactive')
 
-    if user.hash == crypt(passwd, user.salt, 1000).split('$').pop():
-        groups_id = [g.id for g in user.groups]
-
-        claims = {
+    if passwordHash.run(passwordHash.verify, passwd, user.salt, user.hash):
+        if passwordHash.needs_rehash(user.hash):
+            # replace hashes of old formats while the password is known
+            user.salt, user.hash = passwordHash.run(passwordHash.hash_password,
+                                                    passwd)
+            db_session.add(user)
+            try:
+                db_session.commit()
+            except sqlalchemy_exceptions.DBAPIError:
+                # the old hash still works. Try again on the next login
+                db_session.rollback()
+                log().warning('failed to update the hash of ' + user.username)
+
+        claims = dict(template)
+        claims.update({
             'iss': user.key,
             'iat': int(time.time()),
             'exp': int(time.time() + conf.tokenExpiration),
             'profile': user.profile,  # Obsolete. Kept for compatibility
-            'groups': groups_id,
-            'userid': user.id,
 
             # Generate a random string as nonce
             'jti': str(binascii.hexlify(os.urandom(16)), 'ascii'),
-            'service': user.service,
-            'username': user.username
-        }
-        encoded = jwt.encode(claims, user.secret, algorithm='HS256')
+            'service': user.service
+        })
+        if signingKeys.asymmetric():
+            kid, key = signingKeys.keyring.signing_key()
+            encoded = jwt.encode(claims, key, algorithm=conf.tokenAlgorithm,
+                                 headers={'kid': kid})
+        else:
+            encoded = jwt.encode(claims, user.secret, algorithm='HS256')
         log().info('user ' + user.username + ' loged in')
         return str(encoded, 'ascii')
 
     raise AlarmError(403, 'AuthorizationError', username, user.id)
 
 
+# decoded tokens, indexed by a digest of the raw token. Each one is kept
+# until the token expires or its user is invalidated
+token_cache = LocalCache(conf.tokenCacheSize, conf.tokenExpiration)
+
+
+# the signature of a token must be checked again once its user secret
+# may have changed, and a claims template once its groups may have changed
+def on_invalidation(generation_keys):
+    if generation_keys is None or cache.GLOBAL_GENERATION_KEY in generation_keys:
+        token_cache.clear()
+        claims_cache.clear()
+        return
+    users = set(k[len(cache.USER_GENERATION_PREFIX):] for k in generation_keys
+                if k.startswith(cache.USER_GENERATION_PREFIX))
+    if users:
+        token_cache.delete_if(
+            lambda key, payload: str(payload['userid']) in users)
+        claims_cache.delete_if(
+            lambda key, template: str(template['userid']) in users)
+
+
+cache.add_invalidation_listener(on_invalidation)
+
+
+# verifies a token signed with one of the published keys
+def decode_signed_jwt(raw_jwt):
+    try:
+        kid = jwt.get_unverified_header(raw_jwt).get('kid')
+    except jwt.exceptions.DecodeError:
+        raise HTTPRequestError(401, "Corrupted JWT")
+    key = signingKeys.keyring.public_key(kid)
+    if key is None:
+        raise HTTPRequestError(401, "Unknown JWT signing key")
+    try:
+        return jwt.decode(raw_jwt, key, algorithms=[conf.tokenAlgorithm])
+    except jwt.exceptions.ExpiredSignatureError:
+        raise HTTPRequestError(401, "Expired JWT")
+    except jwt.exceptions.InvalidTokenError:
+        raise HTTPRequestError(401, "Invalid JWT signature")
+
+
+def decode_jwt(raw_jwt):
+    try:
+        jwt_payload = jwt.decode(raw_jwt, verify=False)
+    except jwt.exceptions.DecodeError:
+        raise HTTPRequestError(401, "Corrupted JWT")
+
+    if jwt_payload.get('userid', None) is None:
+        raise HTTPRequestError(401, "Invalid JWT payload")
+
+    if not conf.tokenCheckSign:
+        return jwt_payload
+
+    if signingKeys.asymmetric():
+        return decode_signed_jwt(raw_jwt)
+
+    user = db.session.query(User.key, User.secret) \
+        .filter_by(id=jwt_payload['userid']).one_or_none()
+    if user is None:
+        raise HTTPRequestError(401, "Invalid JWT payload")
+    try:
+        return jwt.decode(raw_jwt, user.secret, algorithms=['HS256'],
+                          issuer=user.key)
+    except jwt.exceptions.ExpiredSignatureError:
+        raise HTTPRequestError(401, "Expired JWT")
+    except jwt.exceptions.InvalidTokenError:
+        raise HTTPRequestError(401, "Invalid JWT signature")
+
+
 # this helper function receive a base64 JWT token
 # the function decodes the JWT, checks the signature (if configured to check)
 # and returns the jwt payload as a python dictionary
@@ -70,18 +189,24 @@ def get_jwt_payload(raw_jwt):
     if len(split_token) > 1:
         raw_jwt = split_token[1]
 
-    try:
-        jwt_payload = jwt.decode(raw_jwt, verify=False)
-    except jwt.exceptions.DecodeError:
-        raise HTTPRequestError(401, "Corrupted JWT")
+    digest = hashlib.sha256(raw_jwt.encode('utf-8')).digest()
+    jwt_payload = token_cache.get(digest)
+    if jwt_payload is not None:
+        metrics.inc('auth.token.hit')
+        return dict(jwt_payload)
+    metrics.inc('auth.token.miss')
 
-    if jwt_payload.get('userid', None) is None:
-        raise HTTPRequestError(401, "Invalid JWT payload")
+    jwt_payload = decode_jwt(raw_jwt)
 
-    # TODO: Change signature verification for a public/private key schema
-    # TODO: where Auth has the private key for signing tokens.
+    # never keep a token after it expires
+    ttl = conf.tokenExpiration
+    if isinstance(jwt_payload.get('exp'), (int, float)):
+        ttl = min(ttl, jwt_payload['exp'] - time.time())
+    if ttl > 0:
+        token_cache.set(digest, jwt_payload, ttl)
 
-    return jwt_payload
+    # callers may change the returned dictionary
+    return dict(jwt_payload)
 
 
 def user_id_from_jwt(token):
@@ -9,9 +9,13 @@ import controller.PasswordController as password
 from database.Models import Permission, User, Group, PermissionEnum, PermissionTypeEnum
 import controller.RelationshipController as rship
 from database.Models import UserPermission, GroupPermission, UserGroup
+from database.Models import EffectivePermission, KongOutbox
 from database.flaskAlchemyInit import HTTPRequestError
 from database.inputConf import UserLimits, PermissionLimits, GroupLimits
 import database.Cache as cache
+import controller.PolicyEngine as policy
+from controller.PolicyEngine import is_dangerous_regex
+from utils.pathTemplate import is_template, compile_template, TemplateError
 import database.historicModels as inactiveTables
 import conf
 import kongUtils
@@ -83,7 +87,6 @@ def create_user(db_session, user: User, requester):
     :return: The result of creating this user.
     :raises HTTPRequestError: If username is already in use
     :raises HTTPRequestError: If e-mail is already in use
-    :raises HTTPRequestError: If any problem occurs while configuring Kong
     """
     # Drop invalid fields
     user = {k: user[k] for k in user if k in User.fillable}
@@ -123,20 +126,17 @@ def create_user(db_session, user: User, requester):
     LOGGER.debug("... user instance was created.")
     LOGGER.debug(f"User data is: {user['username']} created by {requester['username']}")
 
-    # If no problems occur to create user (no exceptions), configure kong
-    LOGGER.debug("Configuring Kong...")
-    kong_data = kongUtils.configure_kong(new_user.username)
-    if kong_data is None:
-        LOGGER.warning("Could not configure Kong.")
-        raise HTTPRequestError(500, 'failed to configure verification subsystem')
-    LOGGER.debug("... Kong was successfully configured.")
-    new_user.secret = kong_data['secret']
-    new_user.key = kong_data['key']
-    new_user.kongId = kong_data['kongid']
+    # The shared secret is generated here. Kong is configured on background
+    credentials = kongUtils.generate_credentials()
+    new_user.secret = credentials['secret']
+    new_user.key = credentials['key']
+    new_user.kongId = 'pending'
 
     # Add the new user to the database
     LOGGER.debug("Adding new user to database session...")
     db_session.add(new_user)
+    db_session.flush()
+    KongOutbox.enqueue(new_user.id, new_user.username, KongOutbox.PROVISION)
     LOGGER.debug("... new user was added to database session.")
     LOGGER.debug("Committing database changes...")
     db_session.commit()
@@ -295,6 +295,7 @@ def delete_user(db_session, username: str, requester):
         db_session.execute(
             UserGroup.__table__.delete(UserGroup.user_id == user.id)
         )
+        EffectivePermission.remove_user(user.id)
         cache.delete_key(userid=user.id)
 
         # The user is not hardDeleted.
@@ -309,10 +310,18 @@ def delete_user(db_session, username: str, requester):
         log().info(f"user {user.username} deleted by {requester['username']}")
         log().info(user.safe_dict())
 
-        kongUtils.remove_from_kong(user.username)
-        MVUserPermission.refresh()
-        MVGroupPermission.refresh()
+        # operations not executed yet are replaced by the removal. The
+        # ones being executed are left to finish before it
+        db_session.execute(
+            KongOutbox.__table__.delete(
+                (KongOutbox.user_id == user.id)
+                & KongOutbox.claimed_at.is_(None))
+        )
+        KongOutbox.enqueue(user.id, user.username, KongOutbox.REMOVE)
         db_session.commit()
+        MVUserPermission.schedule_refresh()
+        MVGroupPermission.schedule_refresh()
+        policy.notify_change()
 
         if count_tenant_users(db_session, user.service) == 0:
             log().info(f"will emit tenant lifecycle event {user.service} - DELETE")
@@ -356,16 +365,32 @@ def check_perm(perm):
         raise HTTPRequestError(400, "Method too long")
 
     try:
-        re.match(r'(^' + perm['method'] + ')', "")
+        # also precomputes the methods matched by this pattern
+        policy.method_mask(perm['method'])
     except re.error:
         raise HTTPRequestError(400, perm['method']
                                + " is not a valid regular expression.")
 
-    try:
-        re.match(r'(^' + perm['path'] + ')', "")
-    except re.error:
+    if is_dangerous_regex(perm['method']):
         raise HTTPRequestError(400, perm['method']
-                               + " is not a valid regular expression.")
+                               + " may take exponential time to match"
+                               " (nested or ambiguous repetition).")
+
+    if is_template(perm['path']):
+        try:
+            compile_template(perm['path'])
+        except TemplateError as e:
+            raise HTTPRequestError(400, str(e))
+    else:
+        try:
+            re.match(r'(^' + perm['path'] + ')', "")
+        except re.error:
+            raise HTTPRequestError(400, perm['path']
+                                   + " is not a valid regular expression.")
+        if is_dangerous_regex(perm['path']):
+            raise HTTPRequestError(400, perm['path']
+                                   + " may take exponential time to match"
+                                   " (nested or ambiguous repetition).")
 
 
 def create_perm(db_session, permission, requester):
@@ -458,6 +483,11 @@ def update_perm(db_session, permission: str, perm_data, requester):
             log().info(perm_data)
 
             db_session.commit()
+            # decisions may be shared by many users, drop all of them
+            cache.delete_key()
+            MVUserPermission.schedule_refresh()
+            MVGroupPermission.schedule_refresh()
+            policy.notify_change()
         else:
             raise HTTPRequestError(405, "Can't edit a system permission ")
     except orm_exceptions.NoResultFound:
@@ -483,13 +513,15 @@ def delete_perm(db_session, permission: str, requester):
             db_session.execute(
                 GroupPermission.__table__.delete(GroupPermission.permission_id == perm.id)
             )
+            EffectivePermission.remove_permission(perm.id)
             cache.delete_key(action=perm.method, resource=perm.path)
             log().info(f"permission {perm.name} deleted by {requester['username']}")
             log().info(perm.safe_dict())
             db_session.delete(perm)
             db_session.commit()
-            MVUserPermission.refresh()
-            MVGroupPermission.refresh()
+            MVUserPermission.schedule_refresh()
+            MVGroupPermission.schedule_refresh()
+            policy.notify_change()
         else:
             raise HTTPRequestError(405, "Can't delete a system permission")
     except orm_exceptions.NoResultFound:
@@ -592,16 +624,20 @@ def delete_group(db_session, group, requester):
         db_session.execute(
             GroupPermission.__table__.delete(GroupPermission.group_id == group.id)
         )
+        members = rship.group_members(db_session, group.id)
         db_session.execute(
             UserGroup.__table__.delete(UserGroup.group_id == group.id)
         )
-        cache.delete_key()
+        EffectivePermission.remove_group(group.id)
         log().info('group ' + group.name + ' deleted by '
                    + requester['username'],
                    group.safe_dict())
         db_session.delete(group)
-        MVGroupPermission.refresh()
         db_session.commit()
+        # only the group members may have decisions based on it
+        cache.delete_users(members)
+        MVGroupPermission.schedule_refresh()
+        policy.notify_change()
     except orm_exceptions.NoResultFound:
         raise HTTPRequestError(404, "No group found with this ID")
 
@@ -1,11 +1,22 @@
 import re
+import time
 
-from database.Models import PermissionEnum, UserGroup
-from database.Models import MVUserPermission, MVGroupPermission
+from database.Models import PermissionEnum
+from database.Models import Permission, EffectivePermission
 from database.flaskAlchemyInit import HTTPRequestError
 from controller.AuthenticationController import get_jwt_payload
 import database.Cache as cache
+import controller.PolicyEngine as policy
 from database.flaskAlchemyInit import log
+import conf
+from utils.singleFlight import SingleFlight
+from utils.pathTemplate import is_template, compile_template
+
+# evaluations running on this worker, by (user, action, resource)
+single_flight = SingleFlight()
+
+# seconds between two cache checks while other worker evaluates a decision
+LOCK_POLL_INTERVAL = 0.02
 
 
 # Helper function to check request fields
@@ -20,45 +31,208 @@ def check_request(pdp_request):
         raise HTTPRequestError(400, "Missing resource")
 
 
+# Helper function to check batch request fields
+def check_batch_request(pdp_request):
+    if 'jwt' not in pdp_request.keys() or len(pdp_request['jwt']) == 0:
+        raise HTTPRequestError(400, "Missing JWT")
+
+    requests = pdp_request.get('requests', None)
+    if not isinstance(requests, list) or len(requests) == 0:
+        raise HTTPRequestError(400, "Missing requests")
+    if len(requests) > conf.pdpBatchLimit:
+        raise HTTPRequestError(400, "Too many requests. At most "
+                                    + str(conf.pdpBatchLimit)
+                                    + " are allowed")
+
+    for r in requests:
+        if not isinstance(r, dict):
+            raise HTTPRequestError(400, "Invalid request")
+        if not r.get('action', None):
+            raise HTTPRequestError(400, "Missing action")
+        if not r.get('resource', None):
+            raise HTTPRequestError(400, "Missing resource")
+
+
 def pdp_main(db_session, pdp_request):
     check_request(pdp_request)
     jwt_payload = get_jwt_payload(pdp_request['jwt'])
     user_id = jwt_payload['userid']
+    action = pdp_request['action']
+    resource = pdp_request['resource']
 
     # try to retrieve the veredict from cache
-    cached_veredict = cache.get_key(user_id, pdp_request['action'],
-                                    pdp_request['resource'])
+    snapshot = lookup_snapshot(db_session)
+    subject = cache_subject(snapshot, user_id)
+    key_resource = cache_resource(snapshot, user_id, resource)
+    cached_veredict, version = cache.get_key(subject, action, key_resource)
     # Return the cached answer if it exist
     if cached_veredict:
         log().info('user ' + str(user_id) + ' '
-                   + cached_veredict + ' to ' + pdp_request['action']
-                   + ' on ' + pdp_request['resource'] + ' from cache')
+                   + cached_veredict + ' to ' + action
+                   + ' on ' + resource + ' from cache')
         return cached_veredict
 
+    # concurrent misses for the same decision wait for a single evaluation
+    return single_flight.do(
+        (subject, action, key_resource),
+        lambda: evaluate_once(db_session, user_id, action, resource,
+                              subject, key_resource, version)
+    )
+
 
-    user_groups = [g.group_id for g in UserGroup.query.filter_by(user_id=user_id).all()]
+# evaluate a decision and register it on cache.
+# if configured, other workers evaluating the same decision are
+# detected through a short lived lock on the cache, and their
+# result is waited for instead
+def evaluate_once(db_session, user_id, action, resource,
+                  subject, key_resource, version):
+    lock = None
+    if conf.pdpLockTimeout > 0:
+        lock = cache.acquire_lock(subject, action, key_resource,
+                                  conf.pdpLockTimeout)
+        if lock is None:
+            veredict = wait_for_decision(subject, action, key_resource)
+            if veredict:
+                return veredict
 
-    veredict = iterate_permissions(user_id,
-                                   user_groups,
-                                   pdp_request['action'],
-                                   pdp_request['resource'])
-    # Registry this veredict on cache
-    cache.set_key(user_id,
-                  pdp_request['action'],
-                  pdp_request['resource'],
-                  veredict)
+    try:
+        evaluated_subject, decisions = evaluate(db_session, user_id,
+                                                [(action, resource)])
+        veredict, evaluated_resource = decisions[0]
+        # Registry this veredict on cache
+        cache.set_key(evaluated_subject, action, evaluated_resource,
+                      veredict, version)
+    finally:
+        if lock is not None:
+            cache.release_lock(subject, action, key_resource, lock)
 
     log().info('user ' + str(user_id) + ' '
-               + veredict + ' to ' + pdp_request['action']
-               + ' on ' + pdp_request['resource'] + ' registered on cache')
+               + veredict + ' to ' + action
+               + ' on ' + resource + ' registered on cache')
     return veredict
 
 
-def iterate_permissions(user_id, groups_list, action, resource):
+# wait for another worker to register a decision on the cache
+# return None if it takes longer than the lock timeout
+def wait_for_decision(subject, action, key_resource):
+    deadline = time.time() + conf.pdpLockTimeout / 1000
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        veredict, version = cache.get_key(subject, action, key_resource)
+        if veredict:
+            return veredict
+        if not cache.is_locked(subject, action, key_resource):
+            return None
+    return None
+
+
+# evaluate many (action, resource) pairs for the same user
+# the cache is queried and updated only once
+def pdp_batch(db_session, pdp_request):
+    check_batch_request(pdp_request)
+    jwt_payload = get_jwt_payload(pdp_request['jwt'])
+    user_id = jwt_payload['userid']
+
+    requests = [(r['action'], r['resource'])
+                for r in pdp_request['requests']]
+    snapshot = lookup_snapshot(db_session)
+    veredicts, version = cache.get_keys(
+        cache_subject(snapshot, user_id),
+        [(action, cache_resource(snapshot, user_id, resource))
+         for action, resource in requests]
+    )
+
+    missing = [i for i, v in enumerate(veredicts) if not v]
+    if missing:
+        evaluated_subject, decisions = evaluate(db_session, user_id,
+                                                [requests[i] for i in missing])
+        entries = []
+        for i, (veredict, evaluated_resource) in zip(missing, decisions):
+            veredicts[i] = veredict
+            entries.append((requests[i][0], evaluated_resource, veredict))
+        cache.set_keys(evaluated_subject, entries, version)
+
+    log().info('user ' + str(user_id) + ' got ' + str(len(requests))
+               + ' decisions, ' + str(len(missing)) + ' not from cache')
+    return veredicts
+
+
+# the policy used to build the cache keys, if any
+def lookup_snapshot(db_session):
+    if conf.pdpEngine == 'memory':
+        return policy.current_snapshot(db_session)
+    return None
+
+
+# the subject of the decision cache keys.
+# With the in-memory engine, users holding the same grants share their
+# decisions through a policy fingerprint
+def cache_subject(snapshot, user_id):
+    if snapshot is None:
+        return user_id
+    return 'fp-' + snapshot.fingerprint(user_id)
+
+
+# the resource used on the decision cache keys.
+# With the in-memory engine, resources that will certainly get the same
+# decisions share a single key, e.g. every /device/<id> of most users
+def cache_resource(snapshot, user_id, resource):
+    if snapshot is None:
+        return resource
+    return snapshot.resource_key(user_id, resource)
+
+
+# take decisions for a list of (action, resource) without looking
+# at the cache. The user permissions are loaded only once.
+# Returns the cache subject and a list of (veredict, cache resource).
+# The keys are derived from the same policy used to take the decisions
+def evaluate(db_session, user_id, requests):
+    if conf.pdpEngine == 'memory':
+        snapshot = policy.get_snapshot(db_session)
+        return cache_subject(snapshot, user_id), [
+            (snapshot.evaluate(user_id, action, resource),
+             cache_resource(snapshot, user_id, resource))
+            for action, resource in requests
+        ]
+
+    user_permissions, group_permissions = load_permissions(db_session,
+                                                           user_id)
+    return user_id, [(iterate_permissions(user_permissions,
+                                          group_permissions,
+                                          action, resource),
+                      resource)
+                     for action, resource in requests]
+
+
+# retrieve the user direct permissions and the permissions of all
+# of its groups from the effective permissions. Returns plain rows,
+# not ORM objects
+def load_permissions(db_session, user_id):
+    rows = db_session.query(
+        EffectivePermission.source,
+        Permission.path,
+        Permission.method,
+        Permission.permission
+    ).join(
+        Permission, Permission.id == EffectivePermission.permission_id
+    ).filter(EffectivePermission.user_id == user_id)
+
+    user_permissions = []
+    group_permissions = []
+    for row in rows:
+        if row.source == EffectivePermission.DIRECT:
+            user_permissions.append(row)
+        else:
+            group_permissions.append(row)
+    return user_permissions, group_permissions
+
+
+def iterate_permissions(user_permissions, group_permissions,
+                        action, resource):
     permit = False
 
     # check user direct permissions
-    for p in MVUserPermission.query.filter_by(user_id=user_id):
+    for p in user_permissions:
         log().info('checking for user permissions')
         granted = make_decision(p, action, resource)
         # user permissions have precedence over group permissions
@@ -66,15 +240,14 @@ def iterate_permissions(user_id, groups_list, action, resource):
             return granted.value
 
     # check user group permissions
-    for g in groups_list:
-        for p in MVGroupPermission.query.filter_by(group_id=g):
-            log().info('checking for group permissions')
-            granted = make_decision(p, action, resource)
-            # deny have precedence over permits
-            if granted == PermissionEnum.deny:
-                return granted.value
-            elif granted == PermissionEnum.permit:
-                permit = True
+    for p in group_permissions:
+        log().info('checking for group permissions')
+        granted = make_decision(p, action, resource)
+        # deny have precedence over permits
+        if granted == PermissionEnum.deny:
+            return granted.value
+        elif granted == PermissionEnum.permit:
+            permit = True
 
     if permit:
         return PermissionEnum.permit.value
@@ -86,8 +259,17 @@ def iterate_permissions(user_id, groups_list, action, resource):
 # path + method with it. Return 'permit' or 'deny' if succed matching.
 # return 'notApplicable' otherwise
 def make_decision(permission, method, path):
+    if is_template(permission.path):
+        path_matched = compile_template(permission.path).match(path)
+    else:
+        path_matched = re.match(r'(^' + permission.path + ')', path)
     # if the Path and method Match
-    if re.match(r'(^' + permission.path + ')', path) is not None:
-        if re.match(r'(^' + permission.method + ')', method):
+    if path_matched:
+        bit = policy.METHOD_BITS.get(method)
+        if bit is not None:
+            matched = policy.method_mask(permission.method) & bit
+        else:
+            matched = re.match(r'(^' + permission.method + ')', method)
+        if matched:
             return permission.permission
     return PermissionEnum.notApplicable
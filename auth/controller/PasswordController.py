@@ -3,7 +3,6 @@
 
 import logging
 import binascii
-from pbkdf2 import crypt
 import os
 import datetime
 
@@ -15,6 +14,7 @@ from database.flaskAlchemyInit import HTTPRequestError
 from database.historicModels import PasswdInactive, PasswordRequestInactive
 from database.Models import PasswordRequest, User
 from utils.emailUtils import send_mail
+import utils.passwordHash as passwordHash
 import conf
 
 LOGGER = logging.getLogger('auth.' + __name__)
@@ -118,9 +118,7 @@ def check_password_format(user, password):
 
 
 def create_pwd(password):
-    salt = str(binascii.hexlify(os.urandom(8)), 'ascii')
-    password_hash = crypt(password, salt, 1000).split('$').pop()
-    return salt, password_hash
+    return passwordHash.run(passwordHash.hash_password, password)
 
 
 # update a password.
@@ -129,13 +127,9 @@ def create_pwd(password):
 def update(db_session, user, new_password):
     check_password_format(user, new_password)
 
-    # check actual password
-    if user.hash and (user.hash ==
-                      crypt(new_password, user.salt, 1000).split('$').pop()):
-        raise HTTPRequestError(400, "Please, choose a password"
-                                    " that was not used before.")
-
-    # check all old password from database
+    # check the actual password and the old ones from database
+    # with a single call to the hashing pool
+    used = [(user.salt, user.hash)] if user.hash else []
     if conf.passwdHistoryLen > 0:
         oldpwds = (
                     db_session.query(PasswdInactive)
@@ -143,11 +137,12 @@ def update(db_session, user, new_password):
                     .order_by(PasswdInactive.deletion_date.desc())
                     .limit(conf.passwdHistoryLen)
                    )
+        used += [(pwd.salt, pwd.hash) for pwd in oldpwds]
 
-        for pwd in oldpwds:
-            if pwd.hash == crypt(new_password, pwd.salt, 1000).split('$').pop():
-                raise HTTPRequestError(400, "Please, choose a password"
-                                            " that was not used before")
+    if used and passwordHash.run(passwordHash.matches_any, new_password,
+                                 used):
+        raise HTTPRequestError(400, "Please, choose a password"
+                                    " that was not used before")
     PasswdInactive.createInactiveFromUser(db_session, user)
     return create_pwd(new_password)
 
@@ -166,8 +161,8 @@ def update_endpoint(db_session, user_id, up_data):
     except orm_exceptions.NoResultFound:
         raise HTTPRequestError(404, 'User not found')
 
-    if user.hash and (user.hash ==
-       crypt(up_data['oldpasswd'], user.salt, 1000).split('$').pop()):
+    if passwordHash.run(passwordHash.verify, up_data['oldpasswd'],
+                        user.salt, user.hash):
         user.salt, user.hash = update(db_session, user, up_data['newpasswd'])
         db_session.add(user)
     else:
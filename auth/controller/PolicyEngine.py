@@ -0,0 +1,460 @@
+# In-memory policy engine used by the PDP.
+# Every worker keeps a compiled snapshot of all permissions and grants,
+# so decisions can be taken without querying the database.
+# The snapshot is reloaded whenever the policy generation stored on the
+# cache changes, when this worker changed the policy itself, or when
+# it gets older than conf.pdpEngineTtl
+import hashlib
+import re
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+
+import conf
+import database.Cache as cache
+from database.Models import Permission, PermissionEnum
+from database.Models import UserPermission, GroupPermission, UserGroup
+from database.flaskAlchemyInit import log
+from utils.pathTemplate import is_template, compile_template
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+
+REGEX_METACHARACTERS = set('.^$*+?{}[]\\|()')
+REGEX_QUANTIFIERS = set('*+?{')
+
+
+# check if a pattern has an alternation outside any group. Such patterns,
+# or patterns that close the group they are wrapped in, may match
+# resources that don't start with their literal prefix
+def has_top_level_alternation(pattern):
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 2
+            continue
+        if in_class:
+            if c == ']':
+                in_class = False
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth < 0:
+                return True
+        elif c == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def literal_prefix(pattern):
+    """
+    Extracts the literal text every resource matched by a path pattern
+    starts with.
+    :param pattern: The permission path regular expression
+    :return: The prefix and whether the pattern matches exactly the
+             resources that start with it
+    """
+    if has_top_level_alternation(pattern):
+        return '', False
+
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            prefix.append(pattern[i + 1])
+            i += 2
+        elif c in REGEX_METACHARACTERS:
+            break
+        else:
+            prefix.append(c)
+            i += 1
+
+    rest = pattern[i:]
+    if rest[:1] and rest[0] in REGEX_QUANTIFIERS:
+        # the last literal character may be repeated or omitted
+        return ''.join(prefix[:-1]), False
+    return ''.join(prefix), rest in ['', '(.*)', '.*']
+
+
+def _subpatterns(value):
+    if isinstance(value, sre_parse.SubPattern):
+        yield value
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            yield from _subpatterns(v)
+
+
+REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+
+
+# whether a subpattern can match the same text in more than one way
+def _is_ambiguous(subpattern):
+    for op, value in subpattern:
+        if op == sre_parse.BRANCH:
+            return True
+        if op in REPEATS and value[1] == sre_parse.MAXREPEAT:
+            return True
+        for sub in _subpatterns(value):
+            if _is_ambiguous(sub):
+                return True
+    return False
+
+
+def _has_dangerous_repeat(subpattern):
+    for op, value in subpattern:
+        if op in REPEATS:
+            repeats = value[1] == sre_parse.MAXREPEAT or value[1] > 1
+            if repeats and _is_ambiguous(value[2]):
+                return True
+        for sub in _subpatterns(value):
+            if _has_dangerous_repeat(sub):
+                return True
+    return False
+
+
+def is_dangerous_regex(pattern):
+    """
+    Checks if a regular expression repeats a subpattern that can match the
+    same text in more than one way: one with an alternation or an unbounded
+    quantifier, like '(a+)+', '(a|a)*' or '(.*a){12}'. Such expressions may
+    take exponential time to fail matching a crafted resource.
+    :param pattern: The regular expression
+    :return: True if it is considered dangerous
+    """
+    return _has_dangerous_repeat(sre_parse.parse(pattern))
+
+
+HTTP_METHODS = ['GET', 'HEAD', 'POST', 'PUT', 'DELETE',
+                'CONNECT', 'OPTIONS', 'TRACE', 'PATCH']
+METHOD_BITS = {m: 1 << i for i, m in enumerate(HTTP_METHODS)}
+
+
+@lru_cache(maxsize=1024)
+def method_mask(pattern):
+    """
+    Computes which of the standard HTTP methods a method pattern matches
+    :param pattern: The permission method regular expression
+    :return: A bitmask over HTTP_METHODS. Actions that are not a
+             standard method must still be checked with the expression
+    """
+    regex = re.compile(r'(^' + pattern + ')')
+    mask = 0
+    for m, bit in METHOD_BITS.items():
+        if regex.match(m) is not None:
+            mask |= bit
+    return mask
+
+
+class CompiledPermission:
+    __slots__ = ['id', 'path', 'method', 'methods', 'permission',
+                 'prefix', 'pure']
+
+    def __init__(self, permission_id, path, method, permission):
+        self.id = permission_id
+        if is_template(path):
+            self.path = compile_template(path)
+            self.prefix, self.pure = self.path.prefix(), False
+        else:
+            self.path = re.compile(r'(^' + path + ')')
+            self.prefix, self.pure = literal_prefix(path)
+        self.method = re.compile(r'(^' + method + ')')
+        self.methods = method_mask(method)
+        self.permission = permission
+
+    def match_method(self, method):
+        bit = METHOD_BITS.get(method)
+        if bit is not None:
+            return self.methods & bit != 0
+        return self.method.match(method) is not None
+
+    # same semantics of PDPController.make_decision
+    def match(self, method, path):
+        if self.path.match(path):
+            if self.match_method(method):
+                return self.permission
+        return PermissionEnum.notApplicable
+
+
+class _TrieNode:
+    __slots__ = ['children', 'permissions']
+
+    def __init__(self):
+        self.children = {}
+        self.permissions = []
+
+
+class PathIndex:
+    """
+    Trie over the literal prefixes of a list of permissions.
+    Only the permissions whose prefix is a prefix of the resource can
+    match it, so the regular expressions of the others are never run.
+    """
+
+    def __init__(self, permissions):
+        self.root = _TrieNode()
+        for position, p in enumerate(permissions):
+            node = self.root
+            for c in p.prefix:
+                node = node.children.setdefault(c, _TrieNode())
+            node.permissions.append((position, p))
+
+    def walk(self, resource):
+        """
+        Finds the permissions that may match a resource
+        :param resource: The resource being accessed
+        :return: The candidate permissions, in their original order, and
+                 the length of the shortest prefix of the resource that is
+                 enough to take every decision with them. It is greater
+                 than the resource length if the whole resource is needed
+        """
+        candidates = []
+        needed = 0
+        node = self.root
+        depth = 0
+        while True:
+            for position, p in node.permissions:
+                candidates.append((position, p))
+                needed = max(needed, depth if p.pure else len(resource) + 1)
+
+            if depth == len(resource):
+                if node.children:
+                    # longer prefixes need the whole resource to not match
+                    needed = len(resource) + 1
+                break
+
+            child = node.children.get(resource[depth])
+            if len(node.children) > (child is not None):
+                # the character at this depth tells other prefixes apart
+                needed = max(needed, depth + 1)
+            if child is None:
+                break
+            node = child
+            depth += 1
+
+        candidates.sort(key=lambda c: c[0])
+        return [p for position, p in candidates], needed
+
+
+# Users holding exactly the same grants get the same decisions.
+# The fingerprint identifies them: a hash of the user direct permissions
+# and of its groups, each with its own permissions, so it also changes
+# when a group gains or loses a permission
+def policy_fingerprint(user_permissions, user_groups, group_permissions):
+    groups = sorted(user_groups)
+    description = ','.join(str(p.id) for p in
+                           sorted(user_permissions, key=lambda p: p.id))
+    for g in groups:
+        description += ';' + str(g) + ':' + ','.join(
+            str(p.id) for p in sorted(group_permissions.get(g, ()),
+                                      key=lambda p: p.id))
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()[:32]
+
+
+class PolicySnapshot:
+    def __init__(self, permissions, user_permissions,
+                 group_permissions, user_groups):
+        self.permissions = permissions
+        self.user_permissions = user_permissions
+        self.group_permissions = group_permissions
+        self.user_groups = user_groups
+
+        self.fingerprints = {}
+        for user_id in set(user_permissions) | set(user_groups):
+            self.fingerprints[user_id] = policy_fingerprint(
+                user_permissions.get(user_id, ()),
+                user_groups.get(user_id, ()),
+                group_permissions)
+        self.empty_fingerprint = policy_fingerprint((), (), {})
+
+        self.user_index = {u: PathIndex(perms)
+                           for u, perms in user_permissions.items()}
+        self.group_index = {g: PathIndex(perms)
+                            for g, perms in group_permissions.items()}
+
+    def fingerprint(self, user_id):
+        return self.fingerprints.get(user_id, self.empty_fingerprint)
+
+    def group_indexes(self, user_id):
+        for g in self.user_groups.get(user_id, ()):
+            if g in self.group_index:
+                yield self.group_index[g]
+
+    def evaluate(self, user_id, action, resource):
+        permit = False
+
+        # user permissions have precedence over group permissions
+        if user_id in self.user_index:
+            candidates, _ = self.user_index[user_id].walk(resource)
+            for p in candidates:
+                granted = p.match(action, resource)
+                if granted != PermissionEnum.notApplicable:
+                    return granted.value
+
+        for index in self.group_indexes(user_id):
+            candidates, _ = index.walk(resource)
+            for p in candidates:
+                granted = p.match(action, resource)
+                # deny have precedence over permits
+                if granted == PermissionEnum.deny:
+                    return granted.value
+                elif granted == PermissionEnum.permit:
+                    permit = True
+
+        if permit:
+            return PermissionEnum.permit.value
+        else:
+            return PermissionEnum.deny.value
+
+    def resource_key(self, user_id, resource):
+        """
+        Finds the shortest prefix of a resource that is enough to take
+        every decision about it for this user. Every resource starting
+        with it gets the same decisions, so they can share cache entries.
+        :param user_id: The user ID
+        :param resource: The resource being accessed
+        :return: '~' followed by the prefix, or '=' followed by the whole
+                 resource if no shorter prefix is enough
+        """
+        indexes = list(self.group_indexes(user_id))
+        if user_id in self.user_index:
+            indexes.append(self.user_index[user_id])
+
+        length = 0
+        for index in indexes:
+            length = max(length, index.walk(resource)[1])
+            if length >= len(resource):
+                return '=' + resource
+        return '~' + resource[:length]
+
+
+class PolicyEngine:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.generation = None
+        self.loaded_at = 0
+        self.stale = True
+
+    def is_fresh(self, generation):
+        return (not self.stale
+                and self.snapshot is not None
+                and self.generation == generation
+                and time.time() - self.loaded_at < conf.pdpEngineTtl)
+
+    def load(self, db_session):
+        permissions = {}
+        for p in db_session.query(Permission.id, Permission.path,
+                                  Permission.method, Permission.permission):
+            try:
+                permissions[p.id] = CompiledPermission(p.id, p.path,
+                                                       p.method, p.permission)
+            except (re.error, ValueError):
+                log().warning(f"permission {p.id} is not a valid regular"
+                              " expression or path template. Ignoring it")
+                continue
+            if (not is_template(p.path) and is_dangerous_regex(p.path)) \
+                    or is_dangerous_regex(p.method):
+                log().warning(f"permission {p.id} repeats an alternation or"
+                              " a quantifier and may take exponential time"
+                              " to match")
+
+        user_permissions = defaultdict(list)
+        for user_id, perm_id in db_session.query(UserPermission.user_id,
+                                                 UserPermission.permission_id):
+            if perm_id in permissions:
+                user_permissions[user_id].append(permissions[perm_id])
+
+        group_permissions = defaultdict(list)
+        for group_id, perm_id in db_session.query(GroupPermission.group_id,
+                                                  GroupPermission.permission_id):
+            if perm_id in permissions:
+                group_permissions[group_id].append(permissions[perm_id])
+
+        user_groups = defaultdict(list)
+        for user_id, group_id in db_session.query(UserGroup.user_id,
+                                                  UserGroup.group_id):
+            user_groups[user_id].append(group_id)
+
+        return PolicySnapshot(permissions, dict(user_permissions),
+                              dict(group_permissions), dict(user_groups))
+
+    def get_snapshot(self, db_session):
+        # the generation must be read before loading. If the policy
+        # changes while loading, the next request will reload it again
+        generation = cache.get_policy_generation()
+        if self.is_fresh(generation):
+            return self.snapshot
+
+        with self.lock:
+            if not self.is_fresh(generation):
+                self.stale = False
+                try:
+                    self.snapshot = self.load(db_session)
+                except Exception:
+                    self.stale = True
+                    raise
+                self.generation = generation
+                self.loaded_at = time.time()
+                log().info('policy engine loaded '
+                           + str(len(self.snapshot.permissions))
+                           + ' permissions')
+            return self.snapshot
+
+    # the snapshot currently loaded, without checking the policy
+    # generation on the cache
+    def current_snapshot(self, db_session):
+        snapshot = self.snapshot
+        if (snapshot is not None and not self.stale
+                and time.time() - self.loaded_at < conf.pdpEngineTtl):
+            return snapshot
+        return self.get_snapshot(db_session)
+
+    def evaluate(self, db_session, user_id, action, resource):
+        return self.get_snapshot(db_session).evaluate(user_id, action,
+                                                      resource)
+
+    def notify_change(self):
+        self.stale = True
+        cache.bump_policy_generation()
+
+
+engine = PolicyEngine()
+
+
+# reload the policy when another worker changed it
+def on_invalidation(generation_keys):
+    if generation_keys is None or cache.POLICY_GENERATION_KEY in generation_keys:
+        engine.stale = True
+
+
+cache.add_invalidation_listener(on_invalidation)
+
+
+def evaluate(db_session, user_id, action, resource):
+    return engine.evaluate(db_session, user_id, action, resource)
+
+
+def get_snapshot(db_session):
+    return engine.get_snapshot(db_session)
+
+
+def current_snapshot(db_session):
+    return engine.current_snapshot(db_session)
+
+
+# Must be called after the changes on permissions or grants were committed,
+# so other workers don't reload the old policy
+def notify_change():
+    engine.notify_change()
@@ -0,0 +1,198 @@
+# Executes the Kong operations stored on the outbox table.
+# Every worker process runs one background thread. A worker claims a
+# batch of operations by setting their claimed_at on a short transaction,
+# and calls Kong with no transaction open, so users are never locked
+# while Kong answers. A claim expires after LEASE seconds, so the
+# operations of a worker that died are executed by another one. A failed
+# operation is retried with an exponential backoff
+import datetime
+import threading
+import time
+
+import conf
+import kongUtils
+import utils.metrics as metrics
+from database.Models import KongOutbox, User
+from database.flaskAlchemyInit import db, log
+
+MAX_BACKOFF = 300
+# longer than a batch may take, even if every Kong request times out. An
+# operation whose claim expires is executed again, which is harmless but
+# may reorder it with a newer operation of the same user
+LEASE = 600
+
+outbox = KongOutbox.__table__
+
+
+class OutboxWorker(threading.Thread):
+    def __init__(self, interval, batch):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.batch = batch
+
+    def run(self):
+        while True:
+            try:
+                executed = self.execute_batch()
+            except Exception as e:
+                log().error(f"kong outbox worker failed: {e}")
+                executed = 0
+            finally:
+                db.session.remove()
+            # keep going while there is work to do
+            if executed < self.batch:
+                time.sleep(self.interval)
+
+    def execute_batch(self):
+        operations = claim(self.batch)
+        for op in operations:
+            start = time.time()
+            try:
+                kong_id = execute(op)
+                complete(op, kong_id)
+                metrics.inc('kong.outbox.executed')
+            except Exception as e:
+                # any failure is retried later, so a single operation
+                # can't stop the ones after it
+                db.session.rollback()
+                attempts = release(op, e)
+                metrics.inc('kong.outbox.failed')
+                log().warning(f"kong {op.operation} of {op.username}"
+                              f" failed {attempts} times: {e}")
+            metrics.observe('kong.outbox', time.time() - start)
+        return len(operations)
+
+
+def claimable(table, now):
+    expired = now - datetime.timedelta(seconds=LEASE)
+    return (table.c.next_attempt <= now) \
+        & (table.c.claimed_at.is_(None) | (table.c.claimed_at < expired))
+
+
+def claim(batch):
+    """
+    Claims the next operations to be executed
+    :return: The claimed rows, oldest first
+    """
+    now = datetime.datetime.utcnow()
+    # aliased, so the select isn't correlated with the update below
+    candidate = outbox.alias('candidate')
+    older = outbox.alias('older')
+    # the operations of a user are executed in order, so a newer one
+    # waits while an older one is claimed by another worker
+    waiting = ~db.exists().where(
+        (older.c.user_id == candidate.c.user_id)
+        & (older.c.id < candidate.c.id)
+        & older.c.claimed_at.isnot(None)
+        & (older.c.claimed_at >= now - datetime.timedelta(seconds=LEASE)))
+    ids = db.select([candidate.c.id]) \
+        .where(claimable(candidate, now) & waiting) \
+        .order_by(candidate.c.id) \
+        .limit(batch) \
+        .with_for_update(of=candidate)
+    # rows claimed by a concurrent worker while this one waited for their
+    # lock are checked again, and left out
+    operations = db.session.execute(
+        outbox.update()
+        .where(outbox.c.id.in_(ids) & claimable(outbox, now))
+        .values(claimed_at=now)
+        .returning(*outbox.c)
+    ).fetchall()
+    db.session.commit()
+    return sorted(operations, key=lambda op: op.id)
+
+
+def execute(op):
+    """
+    Calls Kong. No transaction is left open meanwhile
+    :return: The ID of the shared secret, when provisioning
+    """
+    if op.operation == KongOutbox.REMOVE:
+        kongUtils.delete_consumer(op.username)
+        return None
+
+    # the user data is read as it is now, so every change made since
+    # this operation was added is also applied
+    user = db.session.query(User.username, User.key, User.secret) \
+        .filter_by(id=op.user_id).one_or_none()
+    db.session.commit()
+    if user is None:
+        # removed before it was provisioned
+        return None
+    return user.key, kongUtils.provision_consumer(user.username, user.key,
+                                                  user.secret)
+
+
+def complete(op, provisioned):
+    if provisioned is not None:
+        key, kong_id = provisioned
+        # a user whose key changed meanwhile has a newer operation, which
+        # sets its own kongId
+        db.session.execute(
+            User.__table__.update()
+            .where((User.__table__.c.id == op.user_id)
+                   & (User.__table__.c.key == key))
+            .values(kongId=kong_id))
+    db.session.execute(outbox.delete(outbox.c.id == op.id))
+    db.session.commit()
+
+
+def release(op, error):
+    # the row may have been removed with its user meanwhile
+    attempts = op.attempts + 1
+    next_attempt = datetime.datetime.utcnow() + datetime.timedelta(
+        seconds=min(2 ** attempts, MAX_BACKOFF))
+    db.session.execute(
+        outbox.update()
+        .where(outbox.c.id == op.id)
+        .values(attempts=attempts, last_error=str(error),
+                next_attempt=next_attempt, claimed_at=None))
+    db.session.commit()
+    return attempts
+
+
+outbox_worker = None
+outbox_worker_lock = threading.Lock()
+
+
+def start_outbox_worker():
+    global outbox_worker
+    with outbox_worker_lock:
+        if outbox_worker is None:
+            outbox_worker = OutboxWorker(conf.kongOutboxInterval,
+                                         conf.kongOutboxBatch)
+            outbox_worker.start()
+            metrics.gauge('kong.outbox.pending', pending_operations)
+
+
+# read on its own connection, as it is called on any thread
+def pending_operations():
+    return db.engine.execute(
+        db.select([db.func.count()]).select_from(KongOutbox.__table__)
+    ).scalar()
+
+
+def get_provisioning_state(db_session, user):
+    """
+    Tells whether Kong is already configured for a user
+    :param db_session: The postgres session to be used
+    :param user: The user name or ID
+    :return: A dictionary with the state: 'ready', 'pending' or 'retrying'.
+             While retrying, the number of attempts and the last error
+             are also returned
+    :raises HTTPRequestError: If the user doesn't exist
+    """
+    user = User.get_by_name_or_id(user)
+    op = db_session.query(KongOutbox) \
+        .filter_by(user_id=user.id, operation=KongOutbox.PROVISION) \
+        .order_by(KongOutbox.id).first()
+    if op is None:
+        return {'state': 'ready'}
+    if op.attempts == 0:
+        return {'state': 'pending', 'since': str(op.created_date)}
+    return {
+        'state': 'retrying',
+        'since': str(op.created_date),
+        'attempts': op.attempts,
+        'error': op.last_error
+    }
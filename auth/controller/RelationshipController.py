@@ -2,22 +2,95 @@ import sqlalchemy.orm.exc as orm_exceptions
 
 from database.Models import Permission, User, Group
 from database.Models import UserPermission, GroupPermission, UserGroup
+from database.Models import EffectivePermission
 from database.flaskAlchemyInit import HTTPRequestError
 import database.Cache as cache
+import controller.PolicyEngine as policy
 from database.flaskAlchemyInit import log
 from database.Models import MVUserPermission, MVGroupPermission
+import conf
+import utils.signingKeys as signingKeys
 
 
-def add_user_group(db_session, user, group, requester):
+class Changes:
+    """
+    Collects the side effects of relationship changes, so they are
+    applied only once, after every change was committed: materialized
+    view refreshes, cache invalidations and Kong token resets.
+    """
+
+    def __init__(self):
+        self.views = set()
+        self.invalidate_all = False
+        self.invalidate_users = set()
+        self.reset_users = {}
+
+    def refresh(self, view):
+        self.views.add(view)
+
+    def invalidate(self, userid=None):
+        if userid is None:
+            self.invalidate_all = True
+        else:
+            self.invalidate_users.add(userid)
+
+    def reset_token(self, user):
+        # tokens signed with public keys don't depend on the user secret
+        if not signingKeys.asymmetric():
+            self.reset_users[user.id] = user
+
+    def commit(self, db_session):
+        for user in self.reset_users.values():
+            user.reset_token()
+            db_session.add(user)
+        db_session.commit()
+        if not (self.views or self.invalidate_all or self.invalidate_users):
+            # nothing was changed
+            return
+
+        for view in self.views:
+            view.schedule_refresh()
+        # a global invalidation already covers every user
+        if self.invalidate_all:
+            cache.delete_key()
+        else:
+            cache.delete_users(self.invalidate_users)
+        policy.notify_change()
+
+
+def group_members(db_session, group_id):
+    return [user_id for (user_id,) in
+            db_session.query(UserGroup.user_id).filter_by(group_id=group_id)]
+
+
+def get_user(user):
     try:
-        user = User.get_by_name_or_id(user)
+        return User.get_by_name_or_id(user)
     except orm_exceptions.NoResultFound:
         raise HTTPRequestError(404, f"No user found with this ID or name: {user}")
+
+
+def get_group(group):
     try:
-        group = Group.get_by_name_or_id(group)
+        return Group.get_by_name_or_id(group)
     except orm_exceptions.NoResultFound:
         raise HTTPRequestError(404, f"No group found with this ID or name: {group}")
 
+
+def get_permission(permission):
+    try:
+        return Permission.get_by_name_or_id(permission)
+    except orm_exceptions.NoResultFound:
+        raise HTTPRequestError(404, f"No permission found with this ID or name: {permission}")
+
+
+# The functions below change a single relationship and register their
+# side effects on a Changes object. Nothing is committed
+
+def stage_add_user_group(db_session, changes, user, group, requester):
+    user = get_user(user)
+    group = get_group(group)
+
     if db_session.query(UserGroup).filter_by(
                                                 user_id=user.id,
                                                 group_id=group.id
@@ -26,67 +99,34 @@ def add_user_group(db_session, user, group, requester):
 
     r = UserGroup(user_id=user.id, group_id=group.id)
     db_session.add(r)
-    cache.delete_key(userid=user.id)
-
-    user.reset_token()
-    db_session.add(user)
+    EffectivePermission.join_group(user.id, group.id)
+    changes.invalidate(user.id)
+    changes.reset_token(user)
 
     log().info(f"user {user.username} added to group {group.name} by {requester['username']}")
 
-    db_session.commit()
-
 
-def remove_user_group(db_session, user, group, requester):
-    try:
-        user = User.get_by_name_or_id(user)
-    except orm_exceptions.NoResultFound:
-        raise HTTPRequestError(404, "No user found with this ID or name")
-    try:
-        group = Group.get_by_name_or_id(group)
-    except orm_exceptions.NoResultFound:
-        raise HTTPRequestError(404, "No group found with this ID or name")
+def stage_remove_user_group(db_session, changes, user, group, requester):
+    user = get_user(user)
+    group = get_group(group)
     try:
         relation = db_session.query(UserGroup) \
             .filter_by(user_id=user.id, group_id=group.id).one()
-        db_session.delete(relation)
-        cache.delete_key(userid=user.id)
-
-        user.reset_token()
-        db_session.add(user)
-
-        log().info(f"user {user.username} removed from {group.name} by {requester['username']}")
-        db_session.commit()
     except orm_exceptions.NoResultFound:
         raise HTTPRequestError(404, "User is not a member of the group")
 
+    db_session.delete(relation)
+    EffectivePermission.leave_group(user.id, group.id)
+    changes.invalidate(user.id)
+    changes.reset_token(user)
 
-# add a user to a list of groups
-def add_user_many_groups(db_session, user, groups, requester):
-    success = []
-    failed = []
-
-    # if a single group was given. convert to a one element list
-    if not isinstance(groups, list):
-        groups = [groups]
-
-    for g in groups:
-        try:
-            add_user_group(db_session, user, g, requester)
-            success.append(g)
-        except HTTPRequestError:
-            failed.append(g)
-    return success, failed
+    log().info(f"user {user.username} removed from {group.name} by {requester['username']}")
 
 
-def add_group_permission(db_session, group, permission, requester):
-    try:
-        group = Group.get_by_name_or_id(group)
-    except orm_exceptions.NoResultFound:
-        raise HTTPRequestError(404, "No group found with this ID or name")
-    try:
-        perm = Permission.get_by_name_or_id(permission)
-    except orm_exceptions.NoResultFound:
-        raise HTTPRequestError(404, "No permission found with this ID or name")
+def stage_add_group_permission(db_session, changes, group, permission,
+                               requester):
+    group = get_group(group)
+    perm = get_permission(permission)
 
     if db_session.query(GroupPermission) \
             .filter_by(group_id=group.id, permission_id=perm.id).one_or_none():
@@ -94,44 +134,37 @@ def add_group_permission(db_session, group, permission, requester):
 
     r = GroupPermission(group_id=group.id, permission_id=perm.id)
     db_session.add(r)
-    cache.delete_key(action=perm.method,
-                     resource=perm.path)
+    EffectivePermission.grant_group(group.id, perm.id)
+    for user_id in group_members(db_session, group.id):
+        changes.invalidate(user_id)
+    changes.refresh(MVGroupPermission)
+
     log().info(f"permission {perm.name} added to group {group.name} by {requester['username']}")
-    MVGroupPermission.refresh()
-    db_session.commit()
 
 
-def remove_group_permission(db_session, group, permission, requester):
-    try:
-        group = Group.get_by_name_or_id(group)
-    except orm_exceptions.NoResultFound:
-        raise HTTPRequestError(404, "No group found with this ID or name")
-    try:
-        perm = Permission.get_by_name_or_id(permission)
-    except orm_exceptions.NoResultFound:
-        raise HTTPRequestError(404, "No permission found with this ID")
+def stage_remove_group_permission(db_session, changes, group, permission,
+                                  requester):
+    group = get_group(group)
+    perm = get_permission(permission)
     try:
         relation = db_session.query(GroupPermission) \
             .filter_by(group_id=group.id, permission_id=perm.id).one()
-        db_session.delete(relation)
-        cache.delete_key(action=perm.method,
-                         resource=perm.path)
-        log().info(f"permission {perm.name} removed from group {group.name} by {requester['username']}")
-        MVGroupPermission.refresh()
-        db_session.commit()
     except orm_exceptions.NoResultFound:
         raise HTTPRequestError(404, "Group does not have this permission")
 
+    db_session.delete(relation)
+    EffectivePermission.revoke_group(group.id, perm.id)
+    for user_id in group_members(db_session, group.id):
+        changes.invalidate(user_id)
+    changes.refresh(MVGroupPermission)
+
+    log().info(f"permission {perm.name} removed from group {group.name} by {requester['username']}")
 
-def add_user_permission(db_session, user, permission, requester):
-    try:
-        user = User.get_by_name_or_id(user)
-    except orm_exceptions.NoResultFound:
-        raise HTTPRequestError(404, "No user found with this ID or name")
-    try:
-        perm = Permission.get_by_name_or_id(permission)
-    except orm_exceptions.NoResultFound:
-        raise HTTPRequestError(404, "No permission found with this ID")
+
+def stage_add_user_permission(db_session, changes, user, permission,
+                              requester):
+    user = get_user(user)
+    perm = get_permission(permission)
 
     if db_session.query(UserPermission) \
             .filter_by(user_id=user.id, permission_id=perm.id).one_or_none():
@@ -139,32 +172,156 @@ def add_user_permission(db_session, user, permission, requester):
 
     r = UserPermission(user_id=user.id, permission_id=perm.id)
     db_session.add(r)
-    cache.delete_key(userid=user.id,
-                     action=perm.method,
-                     resource=perm.path)
-    MVUserPermission.refresh()
-    db_session.commit()
+    EffectivePermission.grant_user(user.id, perm.id)
+    changes.invalidate(user.id)
+    changes.refresh(MVUserPermission)
+
     log().info(f"user {user.username} received permission {perm.name} by {requester['username']}")
 
 
-def remove_user_permission(db_session, user, permission, requester):
-    try:
-        user = User.get_by_name_or_id(user)
-    except orm_exceptions.NoResultFound:
-        raise HTTPRequestError(404, "No user found with this ID or name")
-    try:
-        perm = Permission.get_by_name_or_id(permission)
-    except orm_exceptions.NoResultFound:
-        raise HTTPRequestError(404, "No permission found with this ID")
+def stage_remove_user_permission(db_session, changes, user, permission,
+                                 requester):
+    user = get_user(user)
+    perm = get_permission(permission)
     try:
         relation = db_session.query(UserPermission) \
             .filter_by(user_id=user.id, permission_id=perm.id).one()
-        db_session.delete(relation)
-        cache.delete_key(userid=user.id,
-                         action=perm.method,
-                         resource=perm.path)
-        log().info(f"permission {perm.name} for user {user.username} was revoked by {requester['username']}")
-        MVUserPermission.refresh()
-        db_session.commit()
     except orm_exceptions.NoResultFound:
         raise HTTPRequestError(404, "User does not have this permission")
+
+    db_session.delete(relation)
+    EffectivePermission.revoke_user(user.id, perm.id)
+    changes.invalidate(user.id)
+    changes.refresh(MVUserPermission)
+
+    log().info(f"permission {perm.name} for user {user.username} was revoked by {requester['username']}")
+
+
+def add_user_group(db_session, user, group, requester):
+    changes = Changes()
+    stage_add_user_group(db_session, changes, user, group, requester)
+    changes.commit(db_session)
+
+
+def remove_user_group(db_session, user, group, requester):
+    changes = Changes()
+    stage_remove_user_group(db_session, changes, user, group, requester)
+    changes.commit(db_session)
+
+
+# add a user to a list of groups
+def add_user_many_groups(db_session, user, groups, requester):
+    success = []
+    failed = []
+
+    # if a single group was given. convert to a one element list
+    if not isinstance(groups, list):
+        groups = [groups]
+
+    # groups that can't be added are skipped. The others are added
+    # with a single commit
+    changes = Changes()
+    for g in groups:
+        try:
+            stage_add_user_group(db_session, changes, user, g, requester)
+            success.append(g)
+        except HTTPRequestError:
+            failed.append(g)
+    changes.commit(db_session)
+    return success, failed
+
+
+def add_group_permission(db_session, group, permission, requester):
+    changes = Changes()
+    stage_add_group_permission(db_session, changes, group, permission,
+                               requester)
+    changes.commit(db_session)
+
+
+def remove_group_permission(db_session, group, permission, requester):
+    changes = Changes()
+    stage_remove_group_permission(db_session, changes, group, permission,
+                                  requester)
+    changes.commit(db_session)
+
+
+def add_user_permission(db_session, user, permission, requester):
+    changes = Changes()
+    stage_add_user_permission(db_session, changes, user, permission,
+                              requester)
+    changes.commit(db_session)
+
+
+def remove_user_permission(db_session, user, permission, requester):
+    changes = Changes()
+    stage_remove_user_permission(db_session, changes, user, permission,
+                                 requester)
+    changes.commit(db_session)
+
+
+CHANGESET_OPERATIONS = {
+    ('add', 'usergroup'): (stage_add_user_group, 'user', 'group'),
+    ('remove', 'usergroup'): (stage_remove_user_group, 'user', 'group'),
+    ('add', 'grouppermission'):
+        (stage_add_group_permission, 'group', 'permission'),
+    ('remove', 'grouppermission'):
+        (stage_remove_group_permission, 'group', 'permission'),
+    ('add', 'userpermission'):
+        (stage_add_user_permission, 'user', 'permission'),
+    ('remove', 'userpermission'):
+        (stage_remove_user_permission, 'user', 'permission'),
+}
+
+
+def check_changeset(changeset):
+    operations = changeset.get('operations', None)
+    if not isinstance(operations, list) or len(operations) == 0:
+        raise HTTPRequestError(400, "Missing operations")
+    if len(operations) > conf.papChangesetLimit:
+        raise HTTPRequestError(400, "Too many operations. At most "
+                                    + str(conf.papChangesetLimit)
+                                    + " are allowed")
+
+    for i, op in enumerate(operations):
+        if not isinstance(op, dict) \
+                or (op.get('op'), op.get('type')) not in CHANGESET_OPERATIONS:
+            raise HTTPRequestError(400, f"Invalid operation {i}")
+        _, first, second = CHANGESET_OPERATIONS[(op['op'], op['type'])]
+        if op.get(first) is None or op.get(second) is None:
+            raise HTTPRequestError(400, f"Operation {i} requires '{first}'"
+                                        f" and '{second}'")
+
+
+def apply_changeset(db_session, changeset, requester):
+    """
+    Applies a list of relationship changes atomically.
+    :param db_session: The postgres session to be used.
+    :param changeset: Dictionary with a list of 'operations'. Each one has
+                      an 'op' ('add' or 'remove'), a 'type' ('usergroup',
+                      'grouppermission' or 'userpermission') and the
+                      related 'user', 'group' and 'permission'.
+    :param requester: Who is applying the changes. This is a dictionary
+                      with two keys: "userid" and "username".
+    :return: The number of applied operations.
+    :raises HTTPRequestError: If any operation fails. No change is applied.
+    """
+    check_changeset(changeset)
+
+    changes = Changes()
+    operations = changeset['operations']
+    try:
+        for i, op in enumerate(operations):
+            stage, first, second = CHANGESET_OPERATIONS[(op['op'],
+                                                         op['type'])]
+            try:
+                stage(db_session, changes, op[first], op[second], requester)
+            except HTTPRequestError as err:
+                raise HTTPRequestError(err.errorCode,
+                                       f"operation {i}: {err.message}")
+    except Exception:
+        db_session.rollback()
+        raise
+
+    changes.commit(db_session)
+    log().info(f"changeset with {len(operations)} operations applied by {requester['username']}")
+    return len(operations)
@@ -4,9 +4,17 @@
 from flask_redis import FlaskRedis
 import redis
 import logging
+import threading
+import binascii
+import json
+import os
+import time
+from collections import OrderedDict
 
 import conf
 from .flaskAlchemyInit import app
+from utils.localCache import LocalCache
+import utils.metrics as metrics
 
 LOGGER = logging.getLogger('auth.' + __name__)
 LOGGER.addHandler(logging.StreamHandler())
@@ -31,50 +39,459 @@ else:
                  + conf.dbName)
     exit(-1)
 
+# Decisions are also kept on the worker memory for a short time.
+# Only used with redis, as without it no decision is cached at all
+local_cache = LocalCache(conf.cacheLocalSize if redis_store else 0,
+                         conf.cacheLocalTtl)
+
+# Every redis key carries a global generation and the generation of its
+# user. Invalidating is a single INCR on one of them: the old keys are
+# never read again and just expire by their TTL.
+GLOBAL_GENERATION_KEY = 'PDP-GEN;global'
+USER_GENERATION_PREFIX = 'PDP-GEN;user;'
+
+# reads both generations and the requested keys in one round trip
+# KEYS: global generation, user generation
+# ARGV: the keys to be read, without their generation
+# returns the generation followed by the values
+GET_SCRIPT = """
+local generation = (redis.call('GET', KEYS[1]) or '0') .. ':'
+                   .. (redis.call('GET', KEYS[2]) or '0')
+local result = {generation}
+for i, key in ipairs(ARGV) do
+    result[i + 1] = redis.call('GET', 'PDP;' .. generation .. ';' .. key)
+end
+return result
+"""
+
+# The policy generation is incremented whenever permissions or grants
+# change, so every worker knows when to reload its policy engine
+POLICY_GENERATION_KEY = 'PDP-POLICY;generation'
+
+# Every invalidation is published, so each worker can drop its local
+# copies. Messages carry a sequence number: a worker that sees a gap
+# missed some of them and drops everything it has
+INVALIDATION_CHANNEL = 'PDP-INVALIDATION'
+INVALIDATION_SEQUENCE_KEY = 'PDP-INVALIDATION;sequence'
+
+# increments the generations and publishes it atomically, so the
+# sequence numbers are seen in order by the subscribers
+# KEYS: the generations to be incremented
+# ARGV: sequence key, channel, message
+INVALIDATE_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    redis.call('INCR', key)
+end
+local sequence = redis.call('INCR', ARGV[1])
+redis.call('PUBLISH', ARGV[2], sequence .. ' ' .. ARGV[3])
+return sequence
+"""
+
+# removes a lock only if it is still held by the given token
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# identifies the messages published by this worker
+WORKER_ID = str(binascii.hexlify(os.urandom(8)), 'ascii')
+
+if redis_store:
+    get_script = redis_store.register_script(GET_SCRIPT)
+    invalidate_script = redis_store.register_script(INVALIDATE_SCRIPT)
+    release_script = redis_store.register_script(RELEASE_SCRIPT)
+
+# functions called with the list of invalidated generation keys, or None
+# when every local copy must be dropped
+invalidation_listeners = []
+
+# incremented on every local invalidation, so decisions evaluated
+# before it are not stored on the local cache
+local_epoch = 0
+
 
 # create a cache key
-def generate_key(userid, action, resource):
+# decisions shared by many users may use a policy fingerprint as userid
+def generate_key(userid, action, resource, generation=None):
     # add a prefix to every key, to avoid colision with others aplications
     key = 'PDP;'
+    if generation is not None:
+        key += generation + ';'
     key += str(userid) + ';' + action + ';' + resource
     return key
 
 
-# utility function to get a value on redis
-# return None if the value can't be found
+def user_generation_key(userid):
+    return USER_GENERATION_PREFIX + str(userid)
+
+
+# read many keys of the same user from redis
+# return the generation they were read with and their values
+def read_keys(userid, keys):
+    result = get_script(keys=[GLOBAL_GENERATION_KEY,
+                              user_generation_key(userid)],
+                        args=keys)
+    return result[0], result[1:]
+
+
+# utility function to get a value on the cache
+# the local cache is checked before redis
+# return the value, or None if it can't be found, and the version
+# that must be given to set_key when storing a new value
 def get_key(userid, action, resource):
-    if redis_store:
-        try:
-            return redis_store.get(generate_key(userid, action, resource))
-        except redis.exceptions.ConnectionError:
-            LOGGER.warning("Failed to connect to redis")
-            return None
+    veredicts, version = get_keys(userid, [(action, resource)])
+    return veredicts[0], version
+
 
+def set_key(userid, action, resource, veredict, version):
+    set_keys(userid, [(action, resource, veredict)], version)
+
+
+# get many values for the same user in a single round trip
+# requests is a list of (action, resource). Missing values are None
+def get_keys(userid, requests):
+    epoch = local_epoch
+    keys = [generate_key(userid, action, resource)
+            for action, resource in requests]
+    veredicts = [local_cache.get(key) for key in keys]
+
+    missing = [i for i, v in enumerate(veredicts) if not v]
+    if not missing or not redis_store:
+        return veredicts, (epoch, None)
 
-def set_key(userid, action, resource, veredict):
     try:
-       redis_store.setex(generate_key(
-                                        userid,
-                                        action,
-                                        resource
-                                      ),
-                          conf.cacheTtl,   # time to live
-                          str(veredict)
-                          )
+        generation, found = read_keys(userid, [keys[i][len('PDP;'):]
+                                               for i in missing])
     except redis.exceptions.ConnectionError:
         LOGGER.warning("Failed to connect to redis")
+        return veredicts, (epoch, None)
+
+    for i, veredict in zip(missing, found):
+        if veredict and epoch == local_epoch:
+            local_cache.set(keys[i], veredict)
+        veredicts[i] = veredict
+    return veredicts, (epoch, generation)
+
+
+# entries is a list of (action, resource, veredict)
+# version is the one returned by get_keys before the evaluation
+def set_keys(userid, entries, version):
+    epoch, generation = version
+    if not redis_store or generation is None:
+        return
+    try:
+        pipe = redis_store.pipeline(transaction=False)
+        for action, resource, veredict in entries:
+            if epoch == local_epoch:
+                local_cache.set(generate_key(userid, action, resource),
+                                str(veredict))
+            pipe.setex(generate_key(userid, action, resource, generation),
+                       conf.cacheTtl,   # time to live
+                       str(veredict))
+        pipe.execute()
+    except redis.exceptions.ConnectionError:
+        LOGGER.warning("Failed to connect to redis")
+
+
+# drop the local copies of the decisions invalidated by a generation key
+def evict_local(generation_keys):
+    global local_epoch
+    local_epoch += 1
+    if GLOBAL_GENERATION_KEY in generation_keys:
+        local_cache.clear()
+    else:
+        users = set(k[len(USER_GENERATION_PREFIX):] for k in generation_keys
+                    if k.startswith(USER_GENERATION_PREFIX))
+        if len(users) == 1:
+            local_cache.delete_matching(generate_key(next(iter(users)),
+                                                     '*', '*'))
+        elif users:
+            # local keys are 'PDP;<userid>;<action>;<resource>'
+            local_cache.delete_if(
+                lambda key, value: key.split(';', 2)[1] in users)
+
+    for listener in invalidation_listeners:
+        listener(generation_keys)
+
+
+# drop every local copy, as some invalidations may have been missed
+def evict_all_local():
+    global local_epoch
+    local_epoch += 1
+    local_cache.clear()
+    for listener in invalidation_listeners:
+        listener(None)
+
+
+def increment_generations(generation_keys):
+    message = json.dumps({'origin': WORKER_ID, 'keys': generation_keys})
+    try:
+        invalidate_script(keys=generation_keys,
+                          args=[INVALIDATION_SEQUENCE_KEY,
+                                INVALIDATION_CHANNEL,
+                                message])
+        metrics.inc('cache.pubsub.published')
+        return True
+    except redis.exceptions.ConnectionError:
+        LOGGER.warning("Failed to connect to redis")
+        return False
+
+
+class InvalidationWorker(threading.Thread):
+    """
+    Increments the cache generations out of the request thread.
+    Pending invalidations are deduplicated, and a pending global
+    invalidation absorbs every user invalidation.
+    """
+
+    def __init__(self, size):
+        super().__init__(daemon=True)
+        self.size = size
+        self.pending = OrderedDict()
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def submit(self, generation_key):
+        """
+        Schedules the increment of a generation
+        :param generation_key: The generation to be incremented
+        :return: False if the queue is full and the caller should
+                 invalidate it by itself
+        """
+        with self.condition:
+            if (GLOBAL_GENERATION_KEY in self.pending
+                    or generation_key in self.pending):
+                metrics.inc('cache.invalidation.coalesced')
+                return True
+
+            if generation_key == GLOBAL_GENERATION_KEY:
+                metrics.inc('cache.invalidation.coalesced',
+                            len(self.pending))
+                self.pending.clear()
+            elif len(self.pending) >= self.size:
+                return False
+
+            self.pending[generation_key] = None
+            metrics.inc('cache.invalidation.enqueued')
+            self.condition.notify_all()
+            return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                keys = list(self.pending)
+                self.pending.clear()
+                self.running = len(keys)
+
+            if increment_generations(keys):
+                metrics.inc('cache.invalidation.executed', len(keys))
+            else:
+                metrics.inc('cache.invalidation.failed', len(keys))
+
+            # decisions read from redis before the increment may have been
+            # stored again on the local cache
+            evict_local(keys)
+
+            with self.condition:
+                self.running = 0
+                self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits until every submitted invalidation was executed
+        :param timeout: Max time to wait in seconds
+        :return: True if there is nothing left to execute
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not self.pending and not self.running, timeout)
+
+    def queue_size(self):
+        return len(self.pending)
 
 
-# invalidate a key. may use regex patterns
+invalidation_worker = None
+invalidation_worker_lock = threading.Lock()
+
+
+def get_invalidation_worker():
+    global invalidation_worker
+    with invalidation_worker_lock:
+        if invalidation_worker is None:
+            invalidation_worker = InvalidationWorker(
+                conf.cacheInvalidationQueue)
+            invalidation_worker.start()
+            metrics.gauge('cache.invalidation.pending',
+                          invalidation_worker.queue_size)
+        return invalidation_worker
+
+
+def lock_key(userid, action, resource):
+    return 'PDP-LOCK;' + str(userid) + ';' + action + ';' + resource
+
+
+# try to get a lock for evaluating a decision
+# return a token to release it or None if it is held by someone else
+def acquire_lock(userid, action, resource, timeout):
+    if not redis_store:
+        return ''
+    token = str(binascii.hexlify(os.urandom(8)), 'ascii')
+    try:
+        if redis_store.set(lock_key(userid, action, resource), token,
+                           px=timeout, nx=True):
+            return token
+        return None
+    except redis.exceptions.ConnectionError:
+        LOGGER.warning("Failed to connect to redis")
+        return ''
+
+
+def release_lock(userid, action, resource, token):
+    if not redis_store or not token:
+        return
+    try:
+        release_script(keys=[lock_key(userid, action, resource)],
+                       args=[token])
+    except redis.exceptions.ConnectionError:
+        LOGGER.warning("Failed to connect to redis")
+
+
+def is_locked(userid, action, resource):
+    if not redis_store:
+        return False
+    try:
+        return redis_store.exists(lock_key(userid, action, resource))
+    except redis.exceptions.ConnectionError:
+        LOGGER.warning("Failed to connect to redis")
+        return False
+
+
+# invalidate the cached decisions of a user, or of every user
+# action and resource are kept for compatibility. Invalidating a
+# single (action, resource) invalidates every decision of the user
 def delete_key(userid='*', action='*', resource='*'):
+    if userid == '*':
+        key = GLOBAL_GENERATION_KEY
+    else:
+        key = user_generation_key(userid)
+    # local copies exist even without redis
+    evict_local([key])
+    if redis_store:
+        invalidate_generations([key])
+
+
+# invalidate every decision of many users at once
+def delete_users(userids):
+    if not userids:
+        return
+
+    keys = [user_generation_key(u) for u in set(userids)]
+    evict_local(keys)
+    if redis_store:
+        invalidate_generations(keys)
+
+
+def invalidate_generations(keys):
+    if conf.cacheInvalidationQueue > 0:
+        worker = get_invalidation_worker()
+        # generations the worker has no room for are incremented here
+        keys = [k for k in keys if not worker.submit(k)]
+        if not keys:
+            return
+        metrics.inc('cache.invalidation.inline', len(keys))
+
+    increment_generations(keys)
+
+
+# wait for every pending invalidation to reach redis.
+# return False if the timeout expired before that
+def flush_invalidations(timeout=None):
+    if invalidation_worker is None:
+        return True
+    return invalidation_worker.flush(timeout)
+
+
+def get_policy_generation():
     if redis_store:
-        # python-RE and Redis use different wildcard representations
-        action = action.replace('(.*)', '*')
-        resource = resource.replace('(.*)', '*')
-        # TODO: put the cache update on a worker thread
-        key = generate_key(userid, action, resource)
         try:
-            for dkey in redis_store.scan_iter(key):
-                redis_store.delete(dkey)
+            return redis_store.get(POLICY_GENERATION_KEY)
         except redis.exceptions.ConnectionError:
             LOGGER.warning("Failed to connect to redis")
+    return None
+
+
+def bump_policy_generation():
+    if redis_store:
+        increment_generations([POLICY_GENERATION_KEY])
+
+
+class InvalidationListener(threading.Thread):
+    """
+    Receives the invalidations published by every worker
+    and drops the matching local copies
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.sequence = None
+
+    def handle(self, data):
+        try:
+            sequence, message = data.split(' ', 1)
+            sequence = int(sequence)
+            message = json.loads(message)
+        except ValueError:
+            LOGGER.warning("Invalid invalidation message: " + str(data))
+            evict_all_local()
+            return
+
+        metrics.inc('cache.pubsub.received')
+        if self.sequence is not None and sequence != self.sequence + 1:
+            LOGGER.warning("Missed invalidation messages "
+                           + str(self.sequence) + " to "
+                           + str(sequence) + ". Dropping local cache")
+            metrics.inc('cache.pubsub.gaps')
+            self.sequence = sequence
+            evict_all_local()
+            return
+        self.sequence = sequence
+
+        # this worker already evicted its own invalidations
+        if message.get('origin') == WORKER_ID:
+            return
+        evict_local(message.get('keys', []))
+
+    def run(self):
+        while True:
+            try:
+                pubsub = redis_store.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # anything may have happened while not subscribed
+                self.sequence = None
+                evict_all_local()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.handle(message['data'])
+            except redis.exceptions.ConnectionError:
+                LOGGER.warning("Failed to connect to redis. "
+                               "Subscribing again")
+                time.sleep(1)
+
+
+invalidation_listener = None
+
+
+# start the thread that applies the invalidations of other workers
+def start_invalidation_listener():
+    global invalidation_listener
+    if redis_store and invalidation_listener is None:
+        invalidation_listener = InvalidationListener()
+        invalidation_listener.start()
+
+
+def add_invalidation_listener(listener):
+    invalidation_listeners.append(listener)
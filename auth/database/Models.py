@@ -11,6 +11,7 @@ from .inputConf import UserLimits, PermissionLimits, GroupLimits
 from .flaskAlchemyInit import db
 from .materialized_view_factory import create_mat_view
 from .materialized_view_factory import refresh_mat_view
+from .materialized_view_factory import schedule_refresh as schedule_view_refresh
 
 from database.flaskAlchemyInit import HTTPRequestError
 
@@ -110,12 +111,14 @@ class User(db.Model):
             }
 
     def reset_token(self):
-        kong_data = kongUtils.reset_kong_secret(self.username, self.kongId)
-
-        if kong_data is not None:
-            self.secret = kong_data['secret']
-            self.key = kong_data['key']
-            self.kongId = kong_data['kongid']
+        """
+        Replaces the user shared secret, invalidating all of its tokens.
+        Kong is configured on background, after the change is committed
+        """
+        credentials = kongUtils.generate_credentials()
+        self.secret = credentials['secret']
+        self.key = credentials['key']
+        KongOutbox.enqueue(self.id, self.username, KongOutbox.PROVISION)
 
     @staticmethod
     def get_by_name_or_id(name_or_id: str):
@@ -220,6 +223,149 @@ class UserGroup(db.Model):
                       primary_key=True, index=True)
 
 
+# Kong operations to be executed on background. They are added on the
+# same transaction of the changes that require them, so they are never
+# lost or executed for changes that were rolled back
+class KongOutbox(db.Model):
+    __tablename__ = 'kong_outbox'
+
+    # configure the consumer and its shared secret as currently stored
+    # on the user, removing any other secret
+    PROVISION = 'provision'
+    # remove the consumer
+    REMOVE = 'remove'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # not a foreign key, removed users must still be removed from Kong
+    user_id = Column(Integer, nullable=False, index=True)
+    username = Column(String(UserLimits.username), nullable=False)
+    operation = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(String, nullable=True)
+    next_attempt = Column(DateTime, nullable=False,
+                          default=datetime.datetime.utcnow, index=True)
+    # set while a worker executes the operation
+    claimed_at = Column(DateTime, nullable=True)
+    created_date = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def enqueue(user_id, username, operation):
+        """
+        Schedules a Kong operation for a user, unless the same operation
+        is already waiting to be executed. Operations are executed with
+        the user data as it is when they run, so a waiting one also
+        covers the newer changes
+        """
+        # operations claimed by a worker may have read the user already,
+        # and must not absorb this change. The lock makes a worker wait
+        # for this transaction before claiming the waiting operation
+        waiting = db.session.query(KongOutbox) \
+            .filter_by(user_id=user_id, operation=operation,
+                       claimed_at=None) \
+            .with_for_update().first()
+        if waiting is None:
+            db.session.add(KongOutbox(user_id=user_id, username=username,
+                                      operation=operation))
+
+
+# Every permission a user holds, directly or through its groups.
+# It is kept up to date by the functions below, called along with each
+# change on the relationship tables, so the PDP reads a single table
+class EffectivePermission(db.Model):
+    __tablename__ = 'effective_permission'
+    user_id = Column(Integer,
+                     ForeignKey('user.id'),
+                     primary_key=True, autoincrement=False, index=True)
+    permission_id = Column(Integer,
+                           ForeignKey('permission.id'),
+                           primary_key=True, autoincrement=False, index=True)
+    # 0 for direct permissions. The group ID otherwise
+    source = Column(Integer, primary_key=True, autoincrement=False,
+                    index=True)
+
+    DIRECT = 0
+
+    def _insert_from(select):
+        # since session.execute() bypasses autoflush, the relationship
+        # rows added to the session must be flushed before
+        db.session.flush()
+        db.session.execute(
+            EffectivePermission.__table__.insert().from_select(
+                ['user_id', 'permission_id', 'source'], select)
+        )
+
+    def _delete(*conditions):
+        db.session.execute(
+            EffectivePermission.__table__.delete(db.and_(*conditions))
+        )
+
+    def grant_user(user_id, permission_id):
+        db.session.add(EffectivePermission(user_id=user_id,
+                                           permission_id=permission_id,
+                                           source=EffectivePermission.DIRECT))
+
+    def revoke_user(user_id, permission_id):
+        EffectivePermission._delete(
+            EffectivePermission.user_id == user_id,
+            EffectivePermission.permission_id == permission_id,
+            EffectivePermission.source == EffectivePermission.DIRECT)
+
+    def grant_group(group_id, permission_id):
+        EffectivePermission._insert_from(
+            db.select([UserGroup.user_id,
+                       db.literal(permission_id),
+                       db.literal(group_id)])
+            .where(UserGroup.group_id == group_id)
+        )
+
+    def revoke_group(group_id, permission_id):
+        EffectivePermission._delete(
+            EffectivePermission.permission_id == permission_id,
+            EffectivePermission.source == group_id)
+
+    def join_group(user_id, group_id):
+        EffectivePermission._insert_from(
+            db.select([db.literal(user_id),
+                       GroupPermission.permission_id,
+                       db.literal(group_id)])
+            .where(GroupPermission.group_id == group_id)
+        )
+
+    def leave_group(user_id, group_id):
+        EffectivePermission._delete(
+            EffectivePermission.user_id == user_id,
+            EffectivePermission.source == group_id)
+
+    def remove_user(user_id):
+        EffectivePermission._delete(EffectivePermission.user_id == user_id)
+
+    def remove_group(group_id):
+        EffectivePermission._delete(EffectivePermission.source == group_id)
+
+    def remove_permission(permission_id):
+        EffectivePermission._delete(
+            EffectivePermission.permission_id == permission_id)
+
+    def rebuild():
+        """
+        Recomputes the whole table from the relationship tables
+        """
+        EffectivePermission._delete(db.true())
+        EffectivePermission._insert_from(
+            db.select([UserPermission.user_id,
+                       UserPermission.permission_id,
+                       db.literal(EffectivePermission.DIRECT)])
+        )
+        EffectivePermission._insert_from(
+            db.select([UserGroup.user_id,
+                       GroupPermission.permission_id,
+                       GroupPermission.group_id])
+            .select_from(db.join(UserGroup.__table__,
+                                 GroupPermission.__table__,
+                                 UserGroup.group_id
+                                 == GroupPermission.group_id))
+        )
+
+
 # table to keep the temporary password reset links
 class PasswordRequest(db.Model):
     __tablename__ = 'passwd_request'
@@ -250,8 +396,15 @@ class MVUserPermission(db.Model):
     def refresh(concurrently=False):
         refresh_mat_view('mv_user_permission', concurrently)
 
+    # refresh on background, after the current changes were committed
+    def schedule_refresh():
+        schedule_view_refresh('mv_user_permission')
+
 
 db.Index('mv_user_permission_user_idx', MVUserPermission.user_id, unique=False)
+# required to refresh the view concurrently
+db.Index('mv_user_permission_unique_idx',
+         MVUserPermission.user_id, MVUserPermission.id, unique=True)
 
 
 class MVGroupPermission(db.Model):
@@ -276,6 +429,13 @@ class MVGroupPermission(db.Model):
     def refresh(concurrently=False):
         refresh_mat_view('mv_group_permission', concurrently)
 
+    # refresh on background, after the current changes were committed
+    def schedule_refresh():
+        schedule_view_refresh('mv_group_permission')
+
 
 db.Index('mv_group_permission_user_idx',
          MVGroupPermission.group_id, unique=False)
+# required to refresh the view concurrently
+db.Index('mv_group_permission_unique_idx',
+         MVGroupPermission.group_id, MVGroupPermission.id, unique=True)
@@ -2,10 +2,15 @@
 # http://www.jeffwidman.com/blog/847/using-sqlalchemy-to-create-and-manage-postgresql-materialized-views/
 # materialized_view_factory.py
 
+import threading
+import time
+
 from sqlalchemy.ext import compiler
 from sqlalchemy.schema import DDLElement
 
-from .flaskAlchemyInit import db
+import conf
+import utils.metrics as metrics
+from .flaskAlchemyInit import db, log
 
 
 class CreateMaterializedView(DDLElement):
@@ -56,6 +61,109 @@ def refresh_mat_view(name, concurrently):
     db.session.execute('REFRESH MATERIALIZED VIEW ' + _con + name)
 
 
+# create the indexes declared after the view was created.
+# CREATE INDEX IF NOT EXISTS needs postgres 9.5
+def create_missing_indexes(table):
+    existing = set(name for (name,) in db.session.execute(
+        'SELECT indexname FROM pg_indexes WHERE tablename = :table',
+        {'table': table.name}))
+    for idx in table.indexes:
+        if idx.name in existing:
+            continue
+        db.session.execute(
+            'CREATE ' + ('UNIQUE ' if idx.unique else '')
+            + 'INDEX ' + idx.name + ' ON ' + table.name
+            + ' (' + ', '.join(c.name for c in idx.columns) + ')'
+        )
+
+
+class RefreshScheduler(threading.Thread):
+    """
+    Refreshes materialized views out of the request thread.
+    Every refresh requested within the delay is coalesced into a single
+    REFRESH ... CONCURRENTLY, which doesn't block the view readers.
+    Views refreshed concurrently need a unique index.
+    """
+
+    def __init__(self, delay):
+        super().__init__(daemon=True)
+        self.delay = delay
+        # view name -> time of the oldest change not refreshed yet
+        self.pending = {}
+        self.running = {}
+        self.condition = threading.Condition()
+
+    def schedule(self, name):
+        """
+        Requests a refresh. Must be called after the changes the view
+        depends on were committed
+        :param name: The materialized view name
+        """
+        with self.condition:
+            if name in self.pending:
+                metrics.inc('db.view.refresh.coalesced')
+            else:
+                self.pending[name] = time.time()
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                deadline = min(self.pending.values()) + self.delay
+                while time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                self.running = self.pending
+                self.pending = {}
+
+            for name, changed_at in self.running.items():
+                started = time.time()
+                try:
+                    with db.engine.connect() as connection:
+                        connection.execution_options(
+                            isolation_level='AUTOCOMMIT'
+                        ).execute('REFRESH MATERIALIZED VIEW CONCURRENTLY '
+                                  + name)
+                    metrics.observe('db.view.refresh', time.time() - started)
+                except Exception as e:
+                    log().warning(f"could not refresh {name}: {e}")
+                    metrics.inc('db.view.refresh.failed')
+                    with self.condition:
+                        # try again later
+                        self.pending.setdefault(name, changed_at)
+
+            with self.condition:
+                self.running = {}
+
+    def staleness(self):
+        """
+        How long ago, in seconds, the oldest change not seen by some
+        view was made
+        """
+        with self.condition:
+            changes = list(self.pending.values()) + \
+                      list(self.running.values())
+        if not changes:
+            return 0
+        return time.time() - min(changes)
+
+
+refresh_scheduler = None
+refresh_scheduler_lock = threading.Lock()
+
+
+def schedule_refresh(name):
+    global refresh_scheduler
+    with refresh_scheduler_lock:
+        if refresh_scheduler is None:
+            refresh_scheduler = RefreshScheduler(
+                conf.dbViewRefreshDelay / 1000)
+            refresh_scheduler.start()
+            metrics.gauge('db.view.staleness', refresh_scheduler.staleness)
+    refresh_scheduler.schedule(name)
+
+
 class MaterializedView(db.Model):
     __abstract__ = True
 
@@ -1,10 +1,7 @@
 #!/usr/bin/python3
 # This script creates the initial groups, permissions and users
 
-import binascii
-import os
 from time import sleep
-from pbkdf2 import crypt
 
 from sqlalchemy import exc as sqlalchemy_exceptions
 import psycopg2
@@ -16,6 +13,8 @@ from database.materialized_view_factory import *
 import conf as CONFIG
 
 import kongUtils as kong
+import utils.passwordHash as passwordHash
+import utils.signingKeys as signingKeys
 
 
 def create_users():
@@ -46,10 +45,8 @@ def create_users():
         user['created_by'] = 0
 
         # hash the password
-        user['salt'] = str(binascii.hexlify(os.urandom(8)), 'ascii')
-        user['hash'] = crypt(user['passwd'],
-                             user['salt'],
-                             1000).split('$').pop()
+        user['salt'], user['hash'] = passwordHash.hash_password(
+            user['passwd'])
         del user['passwd']
         print("Creating a new instance of this user.")
         new_user = User(**user)
@@ -207,6 +204,7 @@ def populate():
     # refresh views
     MVUserPermission.refresh()
     MVGroupPermission.refresh()
+    EffectivePermission.rebuild()
     db.session.commit()
     print("Success")
 
@@ -240,6 +238,17 @@ def create_database(num_retries=10, interval=3):
             db.create_all()
         else:
             print("Database already exists")
+            # tables added after the database was created
+            if not db.engine.has_table('effective_permission'):
+                EffectivePermission.__table__.create(db.engine)
+                EffectivePermission.rebuild()
+            KongOutbox.__table__.create(db.engine, checkfirst=True)
+            create_missing_indexes(MVUserPermission.__table__)
+            create_missing_indexes(MVGroupPermission.__table__)
+            db.session.commit()
 
 create_database()
+# the first signing key is created before any worker starts
+if signingKeys.asymmetric():
+    signingKeys.ensure_key()
 populate()
@@ -2,16 +2,92 @@ import logging
 import requests
 import binascii
 import os
+import time
 from requests import ConnectionError
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 import conf
-from database.flaskAlchemyInit import HTTPRequestError
+import utils.metrics as metrics
 
 LOGGER = logging.getLogger('auth.' + __name__)
 LOGGER.addHandler(logging.StreamHandler())
 LOGGER.setLevel(logging.INFO)
 
 
+class KongClient:
+    """
+    Client for the Kong admin API. Connections are kept alive and reused
+    across calls, every call is bounded by a timeout and the time each
+    one takes is registered on the metrics.
+    Failed connections are retried with backoff. Requests that reached
+    Kong are retried only if they are idempotent, so a POST is never
+    applied twice.
+    """
+
+    def __init__(self, url, pool_size=None):
+        self.url = url
+        self.timeout = (conf.kongConnectTimeout, conf.kongReadTimeout)
+        retry = Retry(total=conf.kongRetries,
+                      backoff_factor=0.1,
+                      status_forcelist=[502, 503, 504],
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_maxsize=pool_size or conf.kongPoolSize,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, operation, method, path, **kwargs):
+        """
+        Sends a request to the Kong admin API
+        :param operation: Name of the call on the metrics
+        :param method: HTTP method
+        :param path: Path relative to the Kong admin URL
+        :return: The response
+        :raises requests.exceptions.RequestException: If Kong can't be
+                reached or doesn't answer in time
+        """
+        start = time.time()
+        try:
+            return self.session.request(method, self.url + path,
+                                        timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            metrics.inc('kong.' + operation + '.failed')
+            raise
+        finally:
+            metrics.observe('kong.' + operation, time.time() - start)
+
+
+kong_client = KongClient(conf.kongURL)
+
+
+class KongError(Exception):
+    pass
+
+
+def generate_credentials():
+    return {
+        'key': str(binascii.hexlify(os.urandom(16)), 'ascii'),
+        'secret': str(binascii.hexlify(os.urandom(16)), 'ascii')
+    }
+
+
+def check_response(response, action, accepted=()):
+    if not (200 <= response.status_code < 300) \
+            and response.status_code not in accepted:
+        raise KongError("failed to %s: %d %s"
+                        % (action, response.status_code, response.reason))
+    return response
+
+
+def create_jwt_credential(username):
+    headers = {"content-type": "application/x-www-form-urlencoded"}
+    return kong_client.request('create_jwt', 'POST',
+                               '/consumers/%s/jwt' % username,
+                               headers=headers)
+
+
 def configure_kong(user):
     # Disable Kong is not advised. Only use for debug purposes
     if conf.kongURL == 'DISABLED':
@@ -22,8 +98,8 @@ def configure_kong(user):
                 }
 
     try:
-        response = requests.post('%s/consumers' % conf.kongURL,
-                                 data={'username': user})
+        response = kong_client.request('create_consumer', 'POST',
+                                       '/consumers', data={'username': user})
         if response.status_code == 409:
             LOGGER.warning("Consumer already exists")
         elif not (200 <= response.status_code < 300):
@@ -32,9 +108,7 @@ def configure_kong(user):
             LOGGER.error(response.json())
             return None
 
-        headers = {"content-type": "application/x-www-form-urlencoded"}
-        response = requests.post('%s/consumers/%s/jwt'
-                                 % (conf.kongURL, user), headers=headers)
+        response = create_jwt_credential(user)
         if not (200 <= response.status_code < 300):
             LOGGER.error("failed to create key: %d %s"
                          % (response.status_code, response.reason))
@@ -50,7 +124,7 @@ def configure_kong(user):
     except ConnectionError as connection_error:
         LOGGER.error(f"Failed to connect to kong: {connection_error}")
         return None
-    except TimeoutError as timeout_error:
+    except requests.Timeout as timeout_error:
         LOGGER.error(f"Kong timed out: {timeout_error}")
         return None
     except requests.TooManyRedirects as redirects_error:
@@ -61,58 +135,61 @@ def configure_kong(user):
         return None
 
 
-# Invalidate old kong shared secret
-def revoke_kong_secret(username, token_id):
-    if conf.kongURL == 'DISABLED':
-        return
-    try:
-        requests.delete("%s/consumers/%s/jwt/%s"
-                        % (conf.kongURL, username, token_id))
-    except ConnectionError:
-        LOGGER.error("Failed to connect to kong")
-        raise HTTPRequestError(500, "Failed to connect to kong")
-        
-
-# Invalidate old kong shared secret and generates a new one
-def reset_kong_secret(username, token_id):
+def provision_consumer(username, key, secret):
+    """
+    Makes Kong have a consumer whose only shared secret is the given one.
+    It can be safely called again after a failure.
+    :param username: The consumer username
+    :param key: The shared secret key, used as the tokens issuer
+    :param secret: The shared secret
+    :return: The ID of the shared secret on Kong
+    :raises KongError: If Kong couldn't be configured
+    """
     if conf.kongURL == 'DISABLED':
-        return
+        return 'noid'
     try:
-        delete_response = requests.delete("%s/consumers/%s/jwt/%s"
-                        % (conf.kongURL, username, token_id))  
-
-        if not (200 <= delete_response.status_code < 300):
-            LOGGER.error("failed to delete key: %d %s"
-                         % (delete_response.status_code, delete_response.reason))
-            LOGGER.error(delete_response.json())
-            return None
-
-        headers = {"content-type": "application/x-www-form-urlencoded"}
-        response = requests.post('%s/consumers/%s/jwt'
-                                 % (conf.kongURL, username), headers=headers)
-        if not (200 <= response.status_code < 300):
-            LOGGER.error("failed to create key: %d %s"
-                         % (response.status_code, response.reason))
-            LOGGER.error(response.json())
-            return None   
-
-        reply = response.json()
-
-        return {
-                'key': reply['key'],
-                'secret': reply['secret'],
-                'kongid': reply['id']
-                }
-    except ConnectionError:
-        LOGGER.error("Failed to connect to kong")
-        raise HTTPRequestError(500, "Failed to connect to kong")
-
-
-def remove_from_kong(user):
+        check_response(
+            kong_client.request('create_consumer', 'POST', '/consumers',
+                                data={'username': username}),
+            'create consumer', accepted=[409])
+
+        credentials = check_response(
+            kong_client.request('list_jwt', 'GET',
+                                '/consumers/%s/jwt' % username),
+            'list keys').json().get('data', [])
+        current = [c for c in credentials if c['key'] == key]
+        if current:
+            kong_id = current[0]['id']
+        else:
+            kong_id = check_response(
+                kong_client.request('create_jwt', 'POST',
+                                    '/consumers/%s/jwt' % username,
+                                    data={'key': key, 'secret': secret}),
+                'create key').json()['id']
+
+        for c in credentials:
+            if c['key'] != key:
+                check_response(
+                    kong_client.request('delete_jwt', 'DELETE',
+                                        '/consumers/%s/jwt/%s'
+                                        % (username, c['id'])),
+                    'revoke key', accepted=[404])
+        return kong_id
+    except requests.exceptions.RequestException as e:
+        raise KongError("failed to contact kong: %s" % e)
+
+
+def delete_consumer(username):
+    """
+    Removes a consumer from Kong, if it exists
+    :raises KongError: If Kong couldn't be configured
+    """
     if conf.kongURL == 'DISABLED':
         return
     try:
-        requests.delete("%s/consumers/%s" % (conf.kongURL, user))
-    except ConnectionError:
-        LOGGER.error("Failed to connect to kong")
-        raise HTTPRequestError(500, "Failed to connect to kong")
+        check_response(
+            kong_client.request('delete_consumer', 'DELETE',
+                                '/consumers/%s' % username),
+            'remove consumer', accepted=[404])
+    except requests.exceptions.RequestException as e:
+        raise KongError("failed to contact kong: %s" % e)
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+# This script finds and repairs differences between the users stored on
+# the database and the consumers configured on Kong, e.g. consumers left
+# behind by a failed removal or users whose shared secret is missing.
+# Users and consumers are read page by page and repairs are executed by
+# a bounded pool of concurrent Kong calls.
+#
+#   python3 reconcileKong.py [--workers N] [--dry-run] [--remove-orphans]
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import conf as CONFIG
+import kongUtils as kong
+from database.flaskAlchemyInit import db
+from database.Models import User, KongOutbox
+
+PAGE_SIZE = 1000
+REPORT_INTERVAL = 5
+
+
+class Report:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_report = self.start
+        self.counters = {'checked': 0, 'skipped': 0, 'out of sync': 0,
+                         'repaired': 0, 'removed': 0, 'failed': 0}
+
+    def inc(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def show(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < REPORT_INTERVAL:
+            return
+        self.last_report = now
+        elapsed = now - self.start
+        with self.lock:
+            counters = dict(self.counters)
+        print(", ".join(f"{v} {k}" for k, v in counters.items())
+              + " in %.1fs (%.1f users/s)"
+              % (elapsed, counters['checked'] / max(elapsed, 0.001)))
+
+
+def kong_pages(path):
+    offset = None
+    while True:
+        params = {'size': PAGE_SIZE}
+        if offset:
+            params['offset'] = offset
+        body = kong.check_response(
+            kong.kong_client.request('list', 'GET', path, params=params),
+            'list ' + path).json()
+        yield body.get('data', [])
+        offset = body.get('offset')
+        if not offset:
+            return
+
+
+# username -> consumer id
+def load_consumers():
+    consumers = {}
+    for page in kong_pages('/consumers'):
+        for c in page:
+            consumers[c['username']] = c['id']
+    return consumers
+
+
+# consumer id -> [(credential id, key)]
+# None if this Kong can't list every credential at once
+def load_credentials():
+    credentials = {}
+    try:
+        for page in kong_pages('/jwts'):
+            for c in page:
+                credentials.setdefault(c['consumer_id'], []).append(
+                    (c['id'], c['key']))
+    except kong.KongError as e:
+        print(f"Could not list credentials ({e})."
+              " Every user will be checked on Kong")
+        return None
+    return credentials
+
+
+def in_sync(user, consumers, credentials):
+    consumer_id = consumers.get(user.username)
+    if consumer_id is None or credentials is None:
+        return False
+    return credentials.get(consumer_id, []) == [(user.kongId, user.key)]
+
+
+def reconcile(workers, dry_run, remove_orphans):
+    report = Report()
+    kong.kong_client = kong.KongClient(CONFIG.kongURL, pool_size=workers)
+
+    print("Reading Kong consumers...")
+    consumers = load_consumers()
+    credentials = load_credentials()
+    print(f"{len(consumers)} consumers found")
+
+    # users with pending operations are left to the outbox worker
+    pending = set(u for (u,) in db.session.query(KongOutbox.user_id))
+
+    updates = []
+    updates_lock = threading.Lock()
+    # bounds the number of tasks waiting on the pool
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def provision(user):
+        try:
+            kong_id = kong.provision_consumer(user.username, user.key,
+                                              user.secret)
+            with updates_lock:
+                updates.append({'user_id': user.id, 'kong_id': kong_id})
+            report.inc('repaired')
+        except kong.KongError as e:
+            print(f"failed to repair {user.username}: {e}")
+            report.inc('failed')
+        finally:
+            slots.release()
+
+    def remove(username):
+        try:
+            kong.delete_consumer(username)
+            report.inc('removed')
+        except kong.KongError as e:
+            print(f"failed to remove {username}: {e}")
+            report.inc('failed')
+        finally:
+            slots.release()
+
+    # saved on its own connection, as users are still being read
+    update = User.__table__.update() \
+        .where(User.__table__.c.id == db.bindparam('user_id')) \
+        .values(kongId=db.bindparam('kong_id'))
+
+    def save_updates():
+        with updates_lock:
+            batch = updates[:]
+            del updates[:]
+        if batch:
+            db.engine.execute(update, batch)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        users = db.session.query(User.id, User.username, User.key,
+                                 User.secret, User.kongId) \
+            .order_by(User.id) \
+            .execution_options(stream_results=True).yield_per(PAGE_SIZE)
+        for user in users:
+            report.inc('checked')
+            synced = in_sync(user, consumers, credentials)
+            # whatever is left are consumers without a user
+            consumers.pop(user.username, None)
+
+            if user.id in pending:
+                report.inc('skipped')
+            elif not synced:
+                report.inc('out of sync')
+                if dry_run:
+                    print(f"user {user.username} is not in sync")
+                else:
+                    slots.acquire()
+                    pool.submit(provision, user)
+
+            if report.counters['checked'] % PAGE_SIZE == 0:
+                save_updates()
+            report.show()
+
+        # consumers without a user
+        for username in consumers:
+            if not remove_orphans or dry_run:
+                print(f"consumer {username} has no user")
+            else:
+                slots.acquire()
+                pool.submit(remove, username)
+            report.show()
+
+    save_updates()
+    report.show(force=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Repairs differences between users and Kong consumers')
+    parser.add_argument('--workers', type=int, default=20,
+                        help='max number of concurrent calls to Kong')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report the differences')
+    parser.add_argument('--remove-orphans', action='store_true',
+                        help='remove consumers that have no user')
+    args = parser.parse_args()
+
+    if CONFIG.kongURL == 'DISABLED':
+        print("Kong is disabled. Nothing to do")
+        exit(0)
+    reconcile(args.workers, args.dry_run, args.remove_orphans)
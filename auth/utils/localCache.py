@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+
+
+class LocalCache:
+    """
+    Bounded in-process LRU cache. Entries expire after a time to live.
+    A cache created with size 0 never stores anything.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Retrieves a value from the cache
+        :param key: The entry key
+        :return: The value or None if it was not found or is expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores a value, evicting the least recently used entry if the
+        cache is full
+        :param key: The entry key
+        :param value: The value to be stored
+        :param ttl: Time to live in seconds. Defaults to the cache ttl
+        """
+        if self.size <= 0:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def delete_matching(self, pattern):
+        """
+        Removes every entry whose key matches a glob style pattern
+        :param pattern: The pattern, using the same wildcards as redis
+        """
+        with self.lock:
+            for key in [k for k in self.entries if fnmatchcase(k, pattern)]:
+                del self.entries[key]
+
+    def delete_if(self, predicate):
+        """
+        Removes every entry that satisfies a predicate
+        :param predicate: Function receiving the key and the value
+        """
+        with self.lock:
+            for key in [k for k, (v, _) in self.entries.items()
+                        if predicate(k, v)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
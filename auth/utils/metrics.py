@@ -0,0 +1,46 @@
+# Minimal in-process metrics registry.
+# Each worker keeps its own counters, gauges and timings,
+# which are exposed as JSON on /admin/metrics
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_timings = {}
+
+
+def inc(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+# register a function that returns the current value of a gauge
+def gauge(name, func):
+    with _lock:
+        _gauges[name] = func
+
+
+# register the duration in seconds of an operation
+def observe(name, seconds):
+    with _lock:
+        timing = _timings.setdefault(name, {'count': 0, 'total': 0.0,
+                                            'max': 0.0})
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+
+
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        timings = {k: dict(v) for k, v in _timings.items()}
+
+    values = {}
+    for name, func in gauges.items():
+        try:
+            values[name] = func()
+        except Exception as e:
+            values[name] = str(e)
+
+    return {'counters': counters, 'gauges': values, 'timings': timings}
@@ -0,0 +1,147 @@
+# Password hashing.
+# Hashes are stored as '$pbkdf2-sha256$<iterations>$<base64 digest>',
+# computed by the C implementation on hashlib. Hashes created by older
+# versions (the last field of pbkdf2.crypt, with 1000 iterations) are
+# still verified, and should be replaced on the next successful login.
+# Hashing is CPU bound and would block every greenlet of a gevent worker,
+# so requests run it on a small process pool through run()
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pbkdf2 import crypt
+
+import conf
+import utils.metrics as metrics
+from database.flaskAlchemyInit import HTTPRequestError
+
+SCHEME = 'pbkdf2-sha256'
+LEGACY_ITERATIONS = 1000
+
+
+def create_salt():
+    return str(binascii.hexlify(os.urandom(16)), 'ascii')
+
+
+def pbkdf2_sha256(password, salt, iterations):
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'),
+                                 salt.encode('utf-8'), iterations)
+    return str(base64.b64encode(digest), 'ascii')
+
+
+def hash_password(password, salt=None, iterations=None):
+    """
+    Hashes a password
+    :param password: The password in plain text
+    :param salt: The salt to be used. A new one is created if not given
+    :param iterations: Defaults to the configured number of iterations
+    :return: A tuple with the salt and the hash
+    """
+    if salt is None:
+        salt = create_salt()
+    if iterations is None:
+        iterations = conf.passwdHashIterations
+    return salt, '$'.join(['', SCHEME, str(iterations),
+                           pbkdf2_sha256(password, salt, iterations)])
+
+
+def parse(password_hash):
+    # returns the iterations and digest, or None for legacy hashes
+    fields = password_hash.split('$')
+    if len(fields) != 4 or fields[0] or fields[1] != SCHEME \
+            or not fields[2].isdigit():
+        return None
+    return int(fields[2]), fields[3]
+
+
+def verify(password, salt, password_hash):
+    """
+    Checks a password against a stored hash, of any supported format
+    :param password: The password in plain text
+    :param salt: The salt stored with the hash
+    :param password_hash: The stored hash
+    :return: True if the password matches
+    """
+    if not password_hash:
+        return False
+    parsed = parse(password_hash)
+    if parsed is None:
+        computed = crypt(password, salt, LEGACY_ITERATIONS).split('$').pop()
+    else:
+        iterations, password_hash = parsed
+        computed = pbkdf2_sha256(password, salt, iterations)
+    return hmac.compare_digest(computed, password_hash)
+
+
+def needs_rehash(password_hash):
+    """
+    Checks if a hash uses an old format or less iterations than configured
+    """
+    parsed = parse(password_hash)
+    return parsed is None or parsed[0] < conf.passwdHashIterations
+
+
+def matches_any(password, hashes):
+    """
+    Checks a password against many stored hashes
+    :param password: The password in plain text
+    :param hashes: List of (salt, hash) tuples
+    :return: True if the password matches any of them
+    """
+    return any(verify(password, salt, password_hash)
+               for salt, password_hash in hashes)
+
+
+pool = None
+pool_lock = threading.Lock()
+pending = 0
+
+
+def get_pool():
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=conf.passwdHashWorkers)
+        metrics.gauge('passwd.hash.pending', lambda: pending)
+    return pool
+
+
+def run(func, *args):
+    """
+    Runs a hashing function on the process pool. The calling greenlet
+    waits for the result without blocking the others
+    :param func: One of the functions of this module
+    :return: The result of func
+    :raises HTTPRequestError: 503 if too many hashes are pending
+    """
+    global pool, pending
+    if conf.passwdHashWorkers <= 0:
+        return func(*args)
+
+    with pool_lock:
+        if pending >= conf.passwdHashQueue:
+            metrics.inc('passwd.hash.rejected')
+            raise HTTPRequestError(503, "Too many concurrent password"
+                                        " operations. Try again later")
+        pending += 1
+        executor = get_pool()
+
+    start = time.time()
+    try:
+        return executor.submit(func, *args).result()
+    except BrokenProcessPool:
+        # a pool process died. A new pool is created on the next call
+        with pool_lock:
+            if pool is executor:
+                pool = None
+        raise HTTPRequestError(503, "Password hashing unavailable."
+                                    " Try again later")
+    finally:
+        with pool_lock:
+            pending -= 1
+        metrics.observe('passwd.hash', time.time() - start)
@@ -0,0 +1,88 @@
+# Path templates: a restricted alternative to regular expressions on
+# permission paths. A template is a path whose segments are literals,
+# placeholders matching exactly one segment ('{id}') or, as the last
+# segment, '**' matching any number of segments. e.g.
+#   /device/{id}/attrs
+#   /flows/**
+# Templates are matched segment by segment, in linear time
+import re
+from functools import lru_cache
+
+PLACEHOLDER = re.compile(r'^\{[A-Za-z_][A-Za-z0-9_]*\}$')
+ANY_SEGMENTS = '**'
+REGEX_METACHARACTERS = set('.^$*+?{}[]\\|()')
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def is_template(path):
+    """
+    Checks if a permission path uses the template syntax.
+    :param path: The permission path
+    :return: True if it has at least one placeholder or '**' segment and
+             every other segment is a literal
+    """
+    segments = path.split('/')
+    found = False
+    for s in segments:
+        if s == ANY_SEGMENTS or PLACEHOLDER.match(s):
+            found = True
+        elif REGEX_METACHARACTERS & set(s):
+            return False
+    return found
+
+
+class PathTemplate:
+    __slots__ = ['template', 'segments', 'rest']
+
+    def __init__(self, template):
+        segments = template.split('/')
+        self.template = template
+        self.rest = segments[-1] == ANY_SEGMENTS
+        if self.rest:
+            segments.pop()
+        if ANY_SEGMENTS in segments:
+            raise TemplateError("'**' must be the last segment of "
+                                + template)
+        # placeholders are stored as None
+        self.segments = [None if PLACEHOLDER.match(s) else s
+                         for s in segments]
+
+    def prefix(self):
+        """
+        The literal text every path matched by this template starts with
+        """
+        literals = []
+        for s in self.segments:
+            if s is None:
+                # a placeholder can't be empty, its slash is always there
+                return '/'.join(literals) + '/'
+            literals.append(s)
+        # '**' also matches no segment at all
+        return '/'.join(literals)
+
+    def match(self, path):
+        """
+        Matches a whole path against this template
+        :param path: The resource being accessed
+        :return: True if it matches
+        """
+        parts = path.split('/')
+        if len(parts) < len(self.segments):
+            return False
+        if len(parts) > len(self.segments) and not self.rest:
+            return False
+        for expected, part in zip(self.segments, parts):
+            if expected is None:
+                if not part:
+                    return False
+            elif expected != part:
+                return False
+        return True
+
+
+@lru_cache(maxsize=1024)
+def compile_template(path):
+    return PathTemplate(path)
@@ -0,0 +1,208 @@
+# Keys used to sign tokens on the asymmetric modes (RS256 and ES256).
+# Every '<kid>.pem' file on the keys directory holds a private key. The
+# public part of every key is published as a JWKS, so tokens signed by a
+# retired key can still be verified until they expire. A new key only
+# signs tokens after PUBLISH_DELAY seconds, once every worker and gateway
+# had the chance to read its public part.
+# To rotate keys, create a new one (create_key) and remove the old file
+# once every token it signed has expired (AUTH_TOKEN_EXP seconds).
+# Workers look for new files every RELOAD_INTERVAL seconds
+import base64
+import json
+import logging
+import os
+import threading
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+import conf
+
+LOGGER = logging.getLogger('auth.' + __name__)
+LOGGER.addHandler(logging.StreamHandler())
+LOGGER.setLevel(logging.INFO)
+
+ASYMMETRIC_ALGORITHMS = ['RS256', 'ES256']
+RELOAD_INTERVAL = 30
+# how long gateways may cache the JWKS
+JWKS_MAX_AGE = 30
+PUBLISH_DELAY = RELOAD_INTERVAL + JWKS_MAX_AGE
+KEY_EXTENSION = '.pem'
+
+
+def asymmetric():
+    return conf.tokenAlgorithm in ASYMMETRIC_ALGORITHMS
+
+
+def generate_private_key(algorithm):
+    if algorithm == 'RS256':
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                        backend=default_backend())
+    return ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+
+def valid_key(key, algorithm):
+    if algorithm == 'RS256':
+        return isinstance(key, rsa.RSAPrivateKey)
+    return isinstance(key, ec.EllipticCurvePrivateKey) \
+        and isinstance(key.curve, ec.SECP256R1)
+
+
+def create_key(directory=None, algorithm=None):
+    """
+    Creates a new signing key. It is used by every worker after their
+    next reload
+    :param directory: Defaults to the configured keys directory
+    :param algorithm: Defaults to the configured token algorithm
+    :return: The key id
+    """
+    directory = directory or conf.tokenKeysDir
+    algorithm = algorithm or conf.tokenAlgorithm
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    # ids are sorted by creation time
+    kid = time.strftime('%Y%m%d%H%M%S', time.gmtime())
+    pem = generate_private_key(algorithm).private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption())
+    # fails if a key with the same id already exists
+    fd = os.open(os.path.join(directory, kid + KEY_EXTENSION),
+                 os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(pem)
+    LOGGER.info(f"created {algorithm} signing key {kid}")
+    return kid
+
+
+def ensure_key():
+    # creates the first signing key
+    if not list_keys(conf.tokenKeysDir):
+        create_key()
+
+
+def list_keys(directory):
+    try:
+        return sorted(f for f in os.listdir(directory)
+                      if f.endswith(KEY_EXTENSION))
+    except FileNotFoundError:
+        return []
+
+
+# coordinates of EC keys keep their leading zeros (length=32 on P-256)
+def b64_uint(value, length=None):
+    raw = value.to_bytes(length or (value.bit_length() + 7) // 8 or 1, 'big')
+    return str(base64.urlsafe_b64encode(raw).rstrip(b'='), 'ascii')
+
+
+def public_jwk(kid, key, algorithm):
+    numbers = key.public_key().public_numbers()
+    jwk = {'kid': kid, 'alg': algorithm, 'use': 'sig'}
+    if algorithm == 'RS256':
+        jwk.update({'kty': 'RSA', 'n': b64_uint(numbers.n),
+                    'e': b64_uint(numbers.e)})
+    else:
+        jwk.update({'kty': 'EC', 'crv': 'P-256',
+                    'x': b64_uint(numbers.x, 32),
+                    'y': b64_uint(numbers.y, 32)})
+    return jwk
+
+
+class KeyRing:
+    """
+    The signing keys found on a directory, reloaded when its files change
+    """
+
+    def __init__(self, directory, algorithm):
+        self.directory = directory
+        self.algorithm = algorithm
+        self.lock = threading.Lock()
+        self.files = None
+        self.checked_at = 0
+        # (kid, private key, file modification time), oldest first
+        self.keys = []
+        self.signing = None
+        self.public = {}
+        self.jwks = json.dumps({'keys': []})
+
+    def refresh(self):
+        if time.time() - self.checked_at < RELOAD_INTERVAL:
+            return
+        with self.lock:
+            if time.time() - self.checked_at < RELOAD_INTERVAL:
+                return
+            files = list_keys(self.directory)
+            if files != self.files:
+                self.load(files)
+            self.signing = self.choose_signing_key()
+            self.checked_at = time.time()
+
+    def load(self, files):
+        keys = []
+        public = {}
+        jwks = []
+        for name in files:
+            kid = name[:-len(KEY_EXTENSION)]
+            try:
+                path = os.path.join(self.directory, name)
+                with open(path, 'rb') as f:
+                    key = serialization.load_pem_private_key(
+                        f.read(), password=None, backend=default_backend())
+                created_at = os.path.getmtime(path)
+            except (OSError, ValueError) as e:
+                LOGGER.error(f"could not load signing key {name}: {e}")
+                continue
+            if not valid_key(key, self.algorithm):
+                LOGGER.error(f"signing key {name} can't be used with "
+                             + self.algorithm)
+                continue
+            keys.append((kid, key, created_at))
+            public[kid] = key.public_key()
+            jwks.append(public_jwk(kid, key, self.algorithm))
+
+        if not keys:
+            LOGGER.error("no signing key found on " + self.directory)
+        self.files = files
+        self.keys = keys
+        self.public = public
+        self.jwks = json.dumps({'keys': jwks})
+
+    def choose_signing_key(self):
+        # the newest published key signs. If none was published for long
+        # enough yet, e.g. on the first run, the oldest one is used
+        published = [k for k in self.keys
+                     if time.time() - k[2] >= PUBLISH_DELAY]
+        candidates = published[-1:] or self.keys[:1]
+        if not candidates:
+            return None
+        kid, key, _ = candidates[0]
+        return kid, key
+
+    def signing_key(self):
+        """
+        :return: A tuple with the id and the private key signing new tokens
+        :raises RuntimeError: If there is no usable key
+        """
+        self.refresh()
+        if self.signing is None:
+            raise RuntimeError("no signing key found on " + self.directory)
+        return self.signing
+
+    def public_key(self, kid):
+        """
+        :return: The public key with this id, or None
+        """
+        self.refresh()
+        return self.public.get(kid)
+
+    def jwks_document(self):
+        """
+        :return: The JWKS with every public key, serialized as JSON
+        """
+        self.refresh()
+        return self.jwks
+
+
+keyring = KeyRing(conf.tokenKeysDir, conf.tokenAlgorithm)
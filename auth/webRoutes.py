@@ -16,13 +16,15 @@ import controller.PDPController as pdpc
 import controller.AuthenticationController as auth
 import controller.ReportController as reports
 import controller.PasswordController as pwdc
-import auth.kongUtils as kong
+import controller.ProvisioningController as provisioning
 from database.flaskAlchemyInit import app, db, format_response
 from database.flaskAlchemyInit import HTTPRequestError, make_response, load_json_from_request
 import database.Cache as cache
 from controller.KafkaPublisher import Publisher
 
 from utils.serialization import json_serial
+import utils.metrics as metrics
+import utils.signingKeys as signingKeys
 from dojot.module import Log
 
 LOGGER = Log().color_log()
@@ -94,6 +96,15 @@ def update_user(user_id):
         return format_response(err.errorCode, err.message)
 
 
+@app.route('/user/<user>/provisioning', methods=['GET'])
+def get_user_provisioning(user):
+    try:
+        state = provisioning.get_provisioning_state(db.session, user)
+        return make_response(json.dumps(state), 200)
+    except HTTPRequestError as err:
+        return format_response(err.errorCode, err.message)
+
+
 @app.route('/user/<user>', methods=['DELETE'])
 def remove_user(user):
     try:
@@ -271,6 +282,19 @@ def add_user_permission(user, permission):
         return format_response(err.errorCode, err.message)
 
 
+# apply many relationship changes at once
+@app.route('/pap/changeset', methods=['POST'])
+def apply_changeset():
+    try:
+        requester = auth.get_jwt_payload(request.headers.get('Authorization'))
+        changeset = load_json_from_request(request)
+        applied = rship.apply_changeset(db.session, changeset, requester)
+        return make_response(json.dumps({"applied": applied,
+                                         "status": "ok"}), 200)
+    except HTTPRequestError as err:
+        return format_response(err.errorCode, err.message)
+
+
 @app.route('/pdp', methods=['POST'])
 def pdp_request():
     try:
@@ -285,6 +309,20 @@ def pdp_request():
         }, default=json_serial), 200)
 
 
+@app.route('/pdp/batch', methods=['POST'])
+def pdp_batch_request():
+    try:
+        pdp_data = load_json_from_request(request)
+        veredicts = pdpc.pdp_batch(db.session, pdp_data)
+    except HTTPRequestError as err:
+        return format_response(err.errorCode, err.message)
+    else:
+        return make_response(json.dumps({
+            "decisions": veredicts,
+            "status": "ok"
+        }, default=json_serial), 200)
+
+
 #  Reports endpoints
 @app.route('/pap/user/<user>/directpermissions', methods=['GET'])
 def get_user_direct_permissions(user):
@@ -365,17 +403,11 @@ def password_reset():
 
         # password updated. Should reconfigure kong and Invalidate
         # all previous logins
-        kong_data = kong.configure_kong(updating_user.username)
-        if kong_data is None:
-            return format_response(500,
-                                   'failed to configure verification subsystem')
-
-        kong.revoke_kong_secret(updating_user.username, updating_user.kongId)
-        updating_user.secret = kong_data['secret']
-        updating_user.key = kong_data['key']
-        updating_user.kongid = kong_data['kongid']
+        updating_user.reset_token()
         db.session.add(updating_user)
         db.session.commit()
+        # tokens signed with the old secret must be checked again
+        cache.delete_key(userid=updating_user.id)
     except HTTPRequestError as err:
         return format_response(err.errorCode, err.message)
     else:
@@ -400,9 +432,27 @@ def update_password():
 @app.route('/admin/dropcache', methods=['DELETE'])
 def drop_cache():
     cache.delete_key()
+    cache.flush_invalidations()
     return format_response(200)
 
 
+# public keys of the asymmetric signing modes, so tokens can be
+# verified without calling auth
+@app.route('/.well-known/jwks.json', methods=['GET'])
+def get_jwks():
+    if not signingKeys.asymmetric():
+        return format_response(404, "Tokens are not signed with public keys")
+    response = make_response(signingKeys.keyring.jwks_document(), 200)
+    response.headers['Cache-Control'] = \
+        f'public, max-age={signingKeys.JWKS_MAX_AGE}'
+    return response
+
+
+@app.route('/admin/metrics', methods=['GET'])
+def get_metrics():
+    return make_response(json.dumps(metrics.snapshot()), 200)
+
+
 @app.route('/admin/tenants', methods=['GET'])
 def list_tenants():
     """Returns a list containing all existing tenants in the system"""
@@ -414,6 +464,10 @@ def list_tenants():
         return format_response(err.errorCode, err.message)
 
 
+# Listen to cache invalidations published by other workers
+cache.start_invalidation_listener()
+provisioning.start_outbox_worker()
+
 # Initializing Kafka publisher
 LOGGER.debug("Starting publisher initialization thread...")
 Publisher().start()
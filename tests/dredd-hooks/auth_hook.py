@@ -1,6 +1,7 @@
 import dredd_hooks as hooks
 import json
 import controller.CRUDController as crud
+import utils.signingKeys as signingKeys
 from database.flaskAlchemyInit import db
 from database.flaskAlchemyInit import HTTPRequestError
 from crud_api_hook import create_sample_groups
@@ -69,3 +70,7 @@ def change_user_id(transaction):
     transaction['fullPath'] = transaction['fullPath'].replace('1', f'{user_id[0]}')
 
 
+@hooks.before("Auth > Token verification keys > Get public keys")
+def skip_without_public_keys(transaction):
+    if not signingKeys.asymmetric():
+        transaction['skip'] = True
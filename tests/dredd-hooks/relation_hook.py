@@ -1,10 +1,16 @@
 import dredd_hooks as hooks
+import json
+from unittest import mock
 import controller.CRUDController as crud
 import controller.RelationshipController as rship
 import crud_api_hook as crud
 import auth_hook as auth
 from database.flaskAlchemyInit import db, HTTPRequestError
 from database.flaskAlchemyInit import log
+from database.Models import User, UserGroup, UserPermission, GroupPermission
+from database.Models import EffectivePermission
+from database.Models import MVUserPermission, MVGroupPermission
+import utils.signingKeys as signingKeys
 
 USER_GROUP = []
 USER_PERMS = []
@@ -89,6 +95,90 @@ def create_sample_associated_group_perm(transaction):
     GROUP_PERMS.append((group_id[0], perm_id))
 
 
+@hooks.before("Relationship management "
+              "> Apply many relationship changes at once "
+              "> Apply a changeset")
+def create_sample_changeset(transaction):
+    global USER_GROUP, USER_PERMS, GROUP_PERMS, REQUESTER
+    user_id, group_id = auth.create_sample_users(transaction)
+    perm_id = crud.create_sample_perms(transaction)
+    # revoked by the changeset
+    rship.add_user_permission(db.session, user_id[0], perm_id, REQUESTER)
+    body = {
+        "operations": [
+            {"op": "add", "type": "usergroup",
+             "user": user_id[0], "group": group_id[2]},
+            {"op": "add", "type": "grouppermission",
+             "group": group_id[2], "permission": perm_id},
+            {"op": "remove", "type": "userpermission",
+             "user": user_id[0], "permission": perm_id}
+        ]
+    }
+    check_changeset_side_effects(body, user_id[0], group_id[2], perm_id)
+    check_failed_changeset(body, user_id[0], group_id[2], perm_id)
+    transaction['request']['body'] = json.dumps(body)
+    USER_GROUP.append((user_id[0], group_id[2]))
+    GROUP_PERMS.append((group_id[2], perm_id))
+    USER_PERMS.append((user_id[0], perm_id))
+
+
+def check_changeset_side_effects(body, user_id, group_id, perm_id):
+    # the same user and group are changed by every operation, but their
+    # side effects are collected only once
+    changes = rship.Changes()
+    for op in body['operations']:
+        stage, first, second = rship.CHANGESET_OPERATIONS[(op['op'],
+                                                           op['type'])]
+        stage(db.session, changes, op[first], op[second], REQUESTER)
+    db.session.rollback()
+
+    assert not changes.invalidate_all
+    assert user_id in changes.invalidate_users
+    assert changes.views == {MVUserPermission, MVGroupPermission}
+    if not signingKeys.asymmetric():
+        assert list(changes.reset_users) == [user_id]
+
+
+def relationships(user_id, group_id, perm_id):
+    return (
+        db.session.query(UserGroup)
+        .filter_by(user_id=user_id, group_id=group_id).count(),
+        db.session.query(GroupPermission)
+        .filter_by(group_id=group_id, permission_id=perm_id).count(),
+        db.session.query(UserPermission)
+        .filter_by(user_id=user_id, permission_id=perm_id).count(),
+        sorted(db.session.query(EffectivePermission.permission_id,
+                                EffectivePermission.source)
+               .filter_by(user_id=user_id)),
+        # reset along with the Kong token
+        db.session.query(User.key, User.secret).filter_by(id=user_id).one()
+    )
+
+
+def check_failed_changeset(body, user_id, group_id, perm_id):
+    # an invalid last operation undoes the previous ones, and neither the
+    # caches nor the user tokens are touched
+    failing = {
+        "operations": body['operations'] + [
+            {"op": "add", "type": "userpermission",
+             "user": user_id, "permission": "no_such_permission"}
+        ]
+    }
+    before = relationships(user_id, group_id, perm_id)
+    with mock.patch.object(rship.cache, 'delete_key') as delete_key, \
+            mock.patch.object(rship.cache, 'delete_users') as delete_users, \
+            mock.patch.object(rship.policy, 'notify_change') as notify:
+        try:
+            rship.apply_changeset(db.session, failing, REQUESTER)
+            raise AssertionError("changeset with an invalid operation"
+                                 " was applied")
+        except HTTPRequestError as e:
+            assert e.errorCode == 404, e.message
+            assert e.message.startswith("operation 3:"), e.message
+    assert not (delete_key.called or delete_users.called or notify.called)
+    assert relationships(user_id, group_id, perm_id) == before
+
+
 @hooks.after("Relationship management "
              "> Manage relationships between users and groups "
              "> Add user to group")
@@ -107,6 +197,9 @@ def create_sample_associated_group_perm(transaction):
 @hooks.after("Relationship management "
              "> Manage relationships between group and permissions "
              "> Revoke a group permission")
+@hooks.after("Relationship management "
+             "> Apply many relationship changes at once "
+             "> Apply a changeset")
 def clean_associations(transaction):
 
     for user_id, group_id in USER_GROUP:
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+# Checks of the password hashes that don't need a running auth
+
+import conf
+from utils.passwordHash import hash_password, verify, needs_rehash
+
+PASSWORD = 'admin'
+# created by pbkdf2.crypt, as stored by older versions
+LEGACY_SALT = 'd2fa1cd1f2dbb5d8a7bde06f9c6c2ab8'
+LEGACY_HASH = 'rkDACMLw5Foo4oaw8znWSUCuTy.NALj6'
+
+
+def check_legacy_hash():
+    assert verify(PASSWORD, LEGACY_SALT, LEGACY_HASH), \
+        'legacy hash should be verified'
+    assert not verify('wrong', LEGACY_SALT, LEGACY_HASH), \
+        'legacy hash should reject a wrong password'
+    assert needs_rehash(LEGACY_HASH), 'legacy hash should be replaced'
+
+
+def check_new_hash():
+    salt, password_hash = hash_password(PASSWORD)
+    assert password_hash.startswith('$pbkdf2-sha256$'), password_hash
+    assert verify(PASSWORD, salt, password_hash), \
+        'new hash should be verified'
+    assert not verify('wrong', salt, password_hash), \
+        'new hash should reject a wrong password'
+    assert not needs_rehash(password_hash), \
+        'new hash should not be replaced'
+
+    # hashes with less iterations than configured are replaced
+    salt, password_hash = hash_password(PASSWORD, salt,
+                                        conf.passwdHashIterations - 1)
+    assert verify(PASSWORD, salt, password_hash)
+    assert needs_rehash(password_hash), \
+        'hash with less iterations should be replaced'
+
+
+def check_missing_hash():
+    assert not verify(PASSWORD, LEGACY_SALT, None), \
+        'missing hash should reject any password'
+    assert not verify(PASSWORD, LEGACY_SALT, ''), \
+        'empty hash should reject any password'
+
+
+if __name__ == '__main__':
+    check_legacy_hash()
+    check_new_hash()
+    check_missing_hash()
+    print('password hash checks ok')
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# Checks of the policy engine that don't need a running auth
+
+import random
+import re
+
+from controller.PolicyEngine import is_dangerous_regex
+from controller.PolicyEngine import CompiledPermission, PolicySnapshot
+from database.Models import PermissionEnum
+from utils.pathTemplate import is_template, compile_template
+
+SEEDS = range(20)
+ACTIONS = ['GET', 'POST', 'DELETE', 'PATCH', 'custom']
+METHODS = ['(.*)', 'GET', 'POST', 'G.*', 'GET|POST', 'P', 'DELETE$']
+PATHS = [
+    '/(.*)', '/device/(.*)', '/device', '/device$', '/device/a$',
+    '/dev(ice|ices)/a', '/a|/b', '/a)|(/b', '(/a)', '/device/a+b',
+    '/device/a?b', '/device/\\.x', '/device/\\d', '/a.b', '/a[bc]',
+    '/a{2}b', '/a/.*', '', 'x', '/device/{id}/a', '/flows/**', '/{id}',
+    '/a/{id}/**', '/device/**'
+]
+PATH_TOKENS = ['a', 'b', '/', 'dev', '.', '.*', '(.*)', '(a|b)', '(ab|a)',
+               'a?', 'a+', 'b*', '\\.', '$', '[ab]', 'a{2}', '|', 'x', ')|(']
+TEMPLATE_SEGMENTS = ['a', 'b', 'dev', '{id}']
+RESOURCE_TOKENS = ['a', 'b', '/', 'dev', 'ice', '.', 'x', '1']
+
+
+def check_dangerous_regexes():
+    rejected = [
+        '(a+)+', '(.*)*', '(x+y?)*', '(a|a)*$', '(a|aa)*$', '(ab|cd)+x',
+        '((ab|cd)e)*', '(.*a){12}$', '/device/(a+)+/'
+    ]
+    accepted = [
+        '(.*)', '/(.*)', '/device/(.*)', '/stream/socketio/', 'GET',
+        '(GET|POST)', '/(device|template)/(.*)', '(a|b)*', '[ab]*c',
+        '(ab)*', 'a{2,5}b', '(a?)'
+    ]
+    for pattern in rejected:
+        assert is_dangerous_regex(pattern), pattern + ' should be rejected'
+    for pattern in accepted:
+        assert not is_dangerous_regex(pattern), \
+            pattern + ' should be accepted'
+
+
+def random_path(rng):
+    if rng.random() < 0.3:
+        segments = [rng.choice(TEMPLATE_SEGMENTS)
+                    for _ in range(rng.randint(1, 3))]
+        if rng.random() < 0.5:
+            segments.append('**')
+        return '/' + '/'.join(segments)
+    return ''.join(rng.choice(PATH_TOKENS) for _ in range(rng.randint(1, 5)))
+
+
+def random_resource(rng):
+    return ''.join(rng.choice(RESOURCE_TOKENS)
+                   for _ in range(rng.randint(0, 6)))
+
+
+# the decision of a single permission, as taken before the policy engine
+# indexed permissions by their prefix
+def legacy_match(permission, action, resource):
+    path, method, granted = permission
+    if is_template(path):
+        matched = compile_template(path).match(resource)
+    else:
+        matched = re.match(r'(^' + path + ')', resource) is not None
+    if matched and re.match(r'(^' + method + ')', action) is not None:
+        return granted
+    return PermissionEnum.notApplicable
+
+
+def legacy_evaluate(permissions, user_permissions, group_permissions,
+                    user_groups, user_id, action, resource):
+    for perm_id in user_permissions.get(user_id, ()):
+        granted = legacy_match(permissions[perm_id], action, resource)
+        if granted != PermissionEnum.notApplicable:
+            return granted.value
+
+    permit = False
+    for group_id in user_groups.get(user_id, ()):
+        for perm_id in group_permissions.get(group_id, ()):
+            granted = legacy_match(permissions[perm_id], action, resource)
+            if granted == PermissionEnum.deny:
+                return granted.value
+            elif granted == PermissionEnum.permit:
+                permit = True
+    if permit:
+        return PermissionEnum.permit.value
+    return PermissionEnum.deny.value
+
+
+def random_policy(rng):
+    permissions = {}
+    candidates = PATHS + [random_path(rng) for _ in range(30)]
+    for path in candidates:
+        try:
+            re.compile(path)
+        except re.error:
+            if not is_template(path):
+                continue
+        if not is_template(path) and is_dangerous_regex(path):
+            continue
+        granted = rng.choice([PermissionEnum.permit, PermissionEnum.deny])
+        permissions[len(permissions) + 1] = (path, rng.choice(METHODS),
+                                             granted)
+
+    ids = list(permissions)
+    user_permissions = {u: rng.sample(ids, rng.randint(0, 4))
+                        for u in range(1, 7)}
+    # users holding a single permission, whose prefix isn't hidden by
+    # the prefixes of others
+    for i in ids:
+        user_permissions[100 + i] = [i]
+    group_permissions = {g: rng.sample(ids, rng.randint(0, 4))
+                         for g in range(1, 5)}
+    user_groups = {u: rng.sample(range(1, 5), rng.randint(0, 3))
+                   for u in range(1, 8)}
+    return permissions, user_permissions, group_permissions, user_groups
+
+
+def check_snapshot_equivalence():
+    for seed in SEEDS:
+        rng = random.Random(seed)
+        permissions, user_permissions, group_permissions, user_groups = \
+            random_policy(rng)
+
+        compiled = {i: CompiledPermission(i, *p)
+                    for i, p in permissions.items()}
+        snapshot = PolicySnapshot(
+            compiled,
+            {u: [compiled[i] for i in ids]
+             for u, ids in user_permissions.items()},
+            {g: [compiled[i] for i in ids]
+             for g, ids in group_permissions.items()},
+            user_groups)
+
+        resources = set(random_resource(rng) for _ in range(150))
+        # resources close to the permissions prefixes
+        for path, _, _ in permissions.values():
+            literal = re.split(r'[\\.^$*+?{}\[\]|()]', path)[0]
+            for length in range(len(literal) + 1):
+                resources.add(literal[:length])
+                resources.add(literal[:length] + rng.choice(RESOURCE_TOKENS))
+        resources = sorted(resources)
+
+        for user_id in list(range(1, 9)) + [100 + i for i in permissions]:
+            decisions = {}
+            for resource in resources:
+                decisions[resource] = [snapshot.evaluate(user_id, action,
+                                                         resource)
+                                       for action in ACTIONS]
+                expected = [legacy_evaluate(permissions, user_permissions,
+                                            group_permissions, user_groups,
+                                            user_id, action, resource)
+                            for action in ACTIONS]
+                assert decisions[resource] == expected, \
+                    f"seed {seed}, user {user_id}, resource '{resource}':" \
+                    f" {decisions[resource]} != {expected}"
+
+            # every resource starting with a key prefix shares its decisions
+            for resource in resources:
+                key = snapshot.resource_key(user_id, resource)
+                if key.startswith('='):
+                    assert key[1:] == resource
+                    continue
+                prefix = key[1:]
+                assert resource.startswith(prefix)
+                for other in resources:
+                    if other.startswith(prefix):
+                        assert decisions[other] == decisions[resource], \
+                            f"seed {seed}, user {user_id}: '{resource}' and" \
+                            f" '{other}' share the key '{key}' but not" \
+                            f" their decisions"
+
+
+if __name__ == '__main__':
+    check_dangerous_regexes()
+    check_snapshot_equivalence()
+    print('policy engine checks ok')
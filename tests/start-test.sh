@@ -9,6 +9,9 @@ python3 ./tests/initialConfTest.py
 rc=$?; if [[ ${rc} != 0 ]]; then exit ${rc}; fi
 echo initialConf.py ok
 
+python3 ./tests/policyEngineTest.py
+python3 ./tests/passwordHashTest.py
+
 echo Starting dredd
 for file in "./docs/auth.apib" "./docs/crud-api.apib" "./docs/relation.apib" "./docs/report.apib"; do
     dredd --hookfiles "./tests/dredd-hooks/*hook.py" --server "gunicorn auth.webRoutes:app --bind 0.0.0.0:5000" --language python ${file} http://127.0.0.1:5000